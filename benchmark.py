@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of the protocol encoders and decoders
+
+Prints the cost per message of producing, both of encoding produce
+requests with the encoder KafkaClient.send_produce_request uses and of
+creating the messages as well, as SimpleProducer does, the cost per
+message of decoding fetch responses, and the cost of decoding a metadata
+response, so changes to kafka/protocol.py can be compared before and
+after:
+
+    python benchmark.py [number of messages] [message size]
+"""
+import struct
+import sys
+import timeit
+
+from kafka.common import FetchRequest, ProduceRequest
+from kafka.protocol import KafkaProtocol, create_message, create_message_set
+
+
+def produce_request(num_messages, size=100):
+    messages = [create_message(b'x' * size, key=b'key')
+                for _ in range(num_messages)]
+    return [ProduceRequest('topic', 0, messages)]
+
+
+def fetch_request(num_partitions):
+    return [FetchRequest('topic%d' % (p % 100), p, 0, 4096)
+            for p in range(num_partitions)]
+
+
+def fetch_response(num_messages, size=100):
+    message_set = bytes(KafkaProtocol._encode_message_set(
+        [create_message(b'x' * size, key=b'key')
+         for _ in range(num_messages)]))
+    topic = b'topic'
+    return b''.join([
+        struct.pack('>ii', 1, 1),
+        struct.pack('>h', len(topic)), topic,
+        struct.pack('>iihqi', 1, 0, 0, num_messages, len(message_set)),
+        message_set,
+    ])
+
+
+def metadata_response(num_topics, num_partitions, num_brokers=3):
+    parts = [struct.pack('>ii', 1, num_brokers)]
+    for node_id in range(num_brokers):
+        host = ('broker%d' % node_id).encode('ascii')
+        parts.append(struct.pack('>ih', node_id, len(host)) + host +
+                     struct.pack('>i', 9092))
+    parts.append(struct.pack('>i', num_topics))
+    for t in range(num_topics):
+        topic = ('topic%d' % t).encode('ascii')
+        parts.append(struct.pack('>hh', 0, len(topic)) + topic +
+                     struct.pack('>i', num_partitions))
+        for p in range(num_partitions):
+            parts.append(struct.pack('>hiii3ii3i', 0, p, p % num_brokers, 3,
+                                     0, 1, 2, 3, 0, 1, 2))
+    return b''.join(parts)
+
+
+def best_of(fn, repeat=5, number=1):
+    return min(timeit.repeat(fn, repeat=repeat, number=number)) / number
+
+
+def main(num_messages=10000, message_size=100):
+    payloads = produce_request(num_messages, message_size)
+    encode = best_of(lambda: KafkaProtocol.encode_produce_request(
+        'client', 1, payloads, acks=1, timeout=1000))
+
+    values = [b'x' * message_size] * num_messages
+    produce = best_of(lambda: KafkaProtocol.encode_produce_request(
+        'client', 1, [ProduceRequest('topic', 0, create_message_set(values))],
+        acks=1, timeout=1000))
+
+    fetches = fetch_request(num_messages)
+    encode_fetch = best_of(lambda: KafkaProtocol.encode_fetch_request(
+        'client', 1, fetches))
+
+    data = fetch_response(num_messages, message_size)
+    decode = best_of(lambda: [
+        list(resp.messages)
+        for resp in KafkaProtocol.decode_fetch_response(data)])
+    decode_views = best_of(lambda: [
+        list(resp.messages)
+        for resp in KafkaProtocol.decode_fetch_response(data, views=True)])
+    decode_unchecked = best_of(lambda: [
+        list(resp.messages)
+        for resp in KafkaProtocol.decode_fetch_response(data, views=True,
+                                                        check_crcs=False)])
+    decode_columnar = best_of(lambda: list(
+        KafkaProtocol.decode_fetch_response(data, columnar=True)))
+
+    metadata = metadata_response(100, 32)
+    decode_metadata = best_of(
+        lambda: KafkaProtocol.decode_metadata_response(metadata))
+
+    print("Python %s, %d messages of %d bytes" %
+          (sys.version.split()[0], num_messages, message_size))
+    print("encode produce request: %8.2f us/message" %
+          (encode / num_messages * 1e6))
+    print("  and create messages:  %8.2f us/message" %
+          (produce / num_messages * 1e6))
+    print("encode fetch request:   %8.2f us/partition" %
+          (encode_fetch / num_messages * 1e6))
+    print("decode fetch response:  %8.2f us/message" %
+          (decode / num_messages * 1e6))
+    print("  with views:           %8.2f us/message" %
+          (decode_views / num_messages * 1e6))
+    print("  and no CRC check:     %8.2f us/message" %
+          (decode_unchecked / num_messages * 1e6))
+    print("  columnar:             %8.2f us/message" %
+          (decode_columnar / num_messages * 1e6))
+    print("decode metadata (100 topics x 32 partitions): %8.2f ms" %
+          (decode_metadata * 1e3))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -7,15 +7,17 @@ __copyright__ = 'Copyright 2012, David Arthur under Apache License, v2.0'
 from kafka.client import KafkaClient
 from kafka.conn import KafkaConnection
 from kafka.protocol import (
-    create_message, create_gzip_message, create_snappy_message
+    create_message, create_gzip_message, create_snappy_message, MessageBatch
 )
 from kafka.producer import SimpleProducer, KeyedProducer
 from kafka.partitioner import RoundRobinPartitioner, HashedPartitioner
-from kafka.consumer import SimpleConsumer, MultiProcessConsumer
+from kafka.consumer import (
+    SimpleConsumer, MultiProcessConsumer, FetchScheduler
+)
 
 __all__ = [
     'KafkaClient', 'KafkaConnection', 'SimpleProducer', 'KeyedProducer',
     'RoundRobinPartitioner', 'HashedPartitioner', 'SimpleConsumer',
-    'MultiProcessConsumer', 'create_message', 'create_gzip_message',
-    'create_snappy_message'
+    'MultiProcessConsumer', 'FetchScheduler', 'create_message', 'create_gzip_message',
+    'create_snappy_message', 'MessageBatch'
 ]
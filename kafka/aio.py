@@ -0,0 +1,643 @@
+"""
+asyncio counterparts of KafkaClient, SimpleProducer and SimpleConsumer
+
+Requires Python 3.4+. Requests are encoded and responses decoded with
+KafkaProtocol, exactly as in the blocking client, but all I/O goes through
+asyncio streams: each broker gets a single connection over which any number
+of coroutines can have requests in flight at once, matched back to their
+callers by correlation id.
+"""
+from __future__ import absolute_import
+
+import asyncio
+import collections
+import logging
+import random
+import struct
+from functools import partial
+from itertools import cycle
+
+import kafka.common
+from kafka.client import KafkaClient, _ClientMetadata
+from kafka.common import (
+    TopicAndPartition, ConnectionError, FailedPayloadsError,
+    LeaderUnavailableError, KafkaUnavailableError,
+    UnknownTopicOrPartitionError, ProduceRequest, FetchRequest,
+    OffsetCommitRequest, OffsetFetchRequest, ConsumerFetchSizeTooSmall,
+    UnsupportedCodecError
+)
+from kafka.conn import collect_hosts, DEFAULT_SOCKET_TIMEOUT_SECONDS
+from kafka.consumer import (
+    AUTO_COMMIT_MSG_COUNT, FETCH_MAX_WAIT_TIME, FETCH_MIN_BYTES,
+    FETCH_BUFFER_SIZE_BYTES, MAX_FETCH_BUFFER_SIZE_BYTES, _grown_buffer_size
+)
+from kafka.producer import Producer
+from kafka.protocol import (
+    KafkaProtocol, CODEC_NONE, ALL_CODECS, create_message_set
+)
+
+log = logging.getLogger("kafka")
+
+
+class AIOKafkaConnection(object):
+    """
+    An asyncio stream connection to a single Kafka broker
+
+    Any number of coroutines may call `request` concurrently; responses are
+    dispatched to the waiting caller by correlation id. The connection is
+    opened on first use and reopened after it fails.
+
+    host:    the host name or IP address of a kafka broker
+    port:    the port number the kafka broker is listening on
+    timeout: default 120. Seconds to wait for connecting and for each
+             response. None means no timeout.
+    loop:    the event loop to use, defaults to asyncio.get_event_loop()
+    """
+    def __init__(self, host, port, timeout=DEFAULT_SOCKET_TIMEOUT_SECONDS,
+                 loop=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._loop = loop or asyncio.get_event_loop()
+        self._reader = None
+        self._writer = None
+        self._read_task = None
+        self._connecting = None
+        self._requests = {}  # correlation_id -> Future
+
+    def __repr__(self):
+        return "<AIOKafkaConnection host=%s port=%d>" % (self.host, self.port)
+
+    ###################
+    #   Private API   #
+    ###################
+
+    @asyncio.coroutine
+    def _connect(self):
+        if self._writer is not None:
+            return
+
+        # Coroutines that need the connection while it is being opened
+        # wait on the same attempt
+        if self._connecting is None:
+            self._connecting = self._loop.create_task(self._open())
+        try:
+            yield from asyncio.shield(self._connecting, loop=self._loop)
+        finally:
+            if self._connecting is not None and self._connecting.done():
+                self._connecting = None
+
+    @asyncio.coroutine
+    def _open(self):
+        try:
+            self._reader, self._writer = yield from asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, loop=self._loop),
+                self.timeout, loop=self._loop)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise ConnectionError("Kafka @ {0}:{1} unreachable: {2}".format(
+                self.host, self.port, e))
+        self._read_task = self._loop.create_task(
+            self._read_responses(self._reader))
+
+    @asyncio.coroutine
+    def _read_responses(self, reader):
+        """
+        Read responses off reader and hand each to its waiting caller
+        """
+        try:
+            while True:
+                size_header = yield from reader.readexactly(4)
+                (size,) = struct.unpack('>i', size_header)
+                resp = yield from reader.readexactly(size)
+                (correlation_id,) = struct.unpack_from('>i', resp)
+
+                future = self._requests.pop(correlation_id, None)
+                if future is None:
+                    log.warning("Dropping response %d from Kafka, nobody is "
+                                "waiting for it", correlation_id)
+                elif not future.done():
+                    future.set_result(resp)
+        except (OSError, asyncio.IncompleteReadError) as e:
+            # The stream may already have been dropped and replaced
+            if self._reader is reader:
+                self._read_task = None
+                self._fail("Kafka @ {0}:{1} went away: {2}".format(
+                    self.host, self.port, e))
+
+    def _fail(self, reason):
+        """
+        Drop the stream and fail every request still waiting on it
+        """
+        if self._read_task is not None:
+            self._read_task.cancel()
+            self._read_task = None
+        self._close_stream()
+        requests, self._requests = self._requests, {}
+        for future in requests.values():
+            if not future.done():
+                future.set_exception(ConnectionError(reason))
+
+    def _close_stream(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    ##################
+    #   Public API   #
+    ##################
+
+    @asyncio.coroutine
+    def request(self, request_id, payload, expect_response=True):
+        """
+        Send a request to Kafka and return the body of its response
+
+        payload is the encoded request or a list of buffers making it up.
+        If expect_response is False (produce requests with acks=0), None
+        is returned as soon as the request has been written.
+        """
+        yield from self._connect()
+
+        future = None
+        if expect_response:
+            future = asyncio.Future(loop=self._loop)
+            self._requests[request_id] = future
+
+        if isinstance(payload, (list, tuple)):
+            self._writer.writelines(payload)
+        else:
+            self._writer.write(payload)
+
+        try:
+            yield from self._writer.drain()
+        except OSError as e:
+            self._requests.pop(request_id, None)
+            reason = "Unable to send payload to Kafka @ {0}:{1}: {2}".format(
+                self.host, self.port, e)
+            self._fail(reason)
+            raise ConnectionError(reason)
+
+        if future is None:
+            return None
+
+        try:
+            return (yield from asyncio.wait_for(future, self.timeout,
+                                                loop=self._loop))
+        except asyncio.TimeoutError:
+            self._requests.pop(request_id, None)
+            raise ConnectionError("Timed out waiting for response %d from "
+                                  "%r" % (request_id, self))
+
+    def close(self):
+        """
+        Close this connection, failing any requests still in flight
+        """
+        self._fail("Connection to Kafka @ {0}:{1} closed".format(
+            self.host, self.port))
+
+
+class AIOKafkaClient(_ClientMetadata):
+    """
+    An asyncio counterpart of KafkaClient
+
+    The send_* methods are coroutines taking the same arguments as those of
+    KafkaClient. Metadata is not loaded on construction; call
+    `load_metadata_for_topics` or let the first request for a topic load it.
+    Concurrent requests needing metadata for the same topics share a single
+    MetadataRequest.
+    """
+
+    CLIENT_ID = KafkaClient.CLIENT_ID
+
+    def __init__(self, hosts, client_id=CLIENT_ID,
+                 timeout=DEFAULT_SOCKET_TIMEOUT_SECONDS, loop=None):
+        self.client_id = client_id
+        self.timeout = timeout
+        self.hosts = collect_hosts(hosts)
+        self._loop = loop or asyncio.get_event_loop()
+
+        self.conns = {}
+        self._init_metadata()
+        self._metadata_loads = {}    # tuple of topics -> Future
+
+    def __repr__(self):
+        return '<AIOKafkaClient client_id=%s>' % (self.client_id)
+
+    ##################
+    #   Private API  #
+    ##################
+
+    def _get_conn(self, host, port):
+        "Get or create a connection to a broker using host and port"
+        host_key = (host, port)
+        if host_key not in self.conns:
+            self.conns[host_key] = AIOKafkaConnection(
+                host, port, timeout=self.timeout, loop=self._loop)
+
+        return self.conns[host_key]
+
+    def _next_id(self):
+        """
+        Generate a new correlation id, shared with KafkaClient
+        """
+        return next(KafkaClient.ID_GEN)
+
+    @asyncio.coroutine
+    def _get_leader_for_partition(self, topic, partition):
+        key = TopicAndPartition(topic, partition)
+        if self.topics_to_brokers.get(key) is None:
+            yield from self.load_metadata_for_topics(topic)
+
+        return self._known_leader(topic, partition)
+
+    @asyncio.coroutine
+    def _send_broker_unaware_request(self, request_id, request):
+        for (host, port) in self.hosts:
+            conn = self._get_conn(host, port)
+            try:
+                return (yield from conn.request(request_id, request))
+            except ConnectionError as e:
+                log.warning("Could not send request [%r] to server %s:%i, "
+                            "trying next server: %s", request, host, port, e)
+
+        raise KafkaUnavailableError("All servers failed to process request")
+
+    @asyncio.coroutine
+    def _send_broker_aware_request(self, payloads, encoder_fn, decoder_fn):
+        """
+        Group payloads by leader, send one request to each leader
+        concurrently and return the responses in the order of the payloads
+        """
+        original_keys = []
+        payloads_by_broker = collections.defaultdict(list)
+
+        for payload in payloads:
+            leader = yield from self._get_leader_for_partition(
+                payload.topic, payload.partition)
+            if leader is None:
+                raise LeaderUnavailableError(
+                    "Leader not available for topic %s partition %s" %
+                    (payload.topic, payload.partition))
+
+            payloads_by_broker[leader].append(payload)
+            original_keys.append((payload.topic, payload.partition))
+
+        brokers = list(payloads_by_broker.keys())
+        requests = []
+        for broker in brokers:
+            conn = self._get_conn(broker.host, broker.port)
+            request_id = self._next_id()
+            request = encoder_fn(client_id=self.client_id,
+                                 correlation_id=request_id,
+                                 payloads=payloads_by_broker[broker])
+            requests.append(conn.request(request_id, request,
+                                         expect_response=decoder_fn is not None))
+
+        results = yield from asyncio.gather(*requests, loop=self._loop,
+                                            return_exceptions=True)
+
+        acc = {}
+        failed_payloads = []
+        failed_brokers = []
+        for broker, result in zip(brokers, results):
+            if isinstance(result, ConnectionError):
+                log.warning("Could not get response from server %s: %s",
+                            broker, result)
+                failed_payloads += payloads_by_broker[broker]
+                failed_brokers.append(broker)
+                continue
+            elif isinstance(result, Exception):
+                raise result
+
+            if decoder_fn is None:
+                continue
+
+            for response in decoder_fn(result):
+                acc[(response.topic, response.partition)] = response
+
+        if failed_brokers:
+            yield from self._refresh_metadata_for_brokers(failed_brokers)
+
+        if failed_payloads:
+            raise FailedPayloadsError(failed_payloads)
+
+        return [acc[k] for k in original_keys] if acc else []
+
+    @asyncio.coroutine
+    def _refresh_metadata_for_brokers(self, brokers):
+        """
+        Forget which partitions the failed brokers lead and reload the
+        metadata of their topics with a single request
+        """
+        topics = self.reset_broker_metadata(*brokers)
+        if not topics:
+            return
+
+        try:
+            yield from self.load_metadata_for_topics(*topics)
+        except Exception as e:
+            log.warning("Could not refresh metadata for topics %s: %s",
+                        topics, e)
+
+    #################
+    #   Public API  #
+    #################
+
+    def close(self):
+        for conn in self.conns.values():
+            conn.close()
+
+    @asyncio.coroutine
+    def load_metadata_for_topics(self, *topics):
+        """
+        Discover brokers and metadata for a set of topics
+
+        Concurrent calls for the same set of topics wait on a single
+        MetadataRequest.
+        """
+        key = tuple(sorted(topics))
+        if key not in self._metadata_loads:
+            self._metadata_loads[key] = self._loop.create_task(
+                self._load_metadata_for_topics(topics))
+            self._metadata_loads[key].add_done_callback(
+                lambda _: self._metadata_loads.pop(key, None))
+
+        yield from asyncio.shield(self._metadata_loads[key], loop=self._loop)
+
+    @asyncio.coroutine
+    def _load_metadata_for_topics(self, topics):
+        request_id = self._next_id()
+        request = KafkaProtocol.encode_metadata_request(self.client_id,
+                                                        request_id, topics)
+
+        response = yield from self._send_broker_unaware_request(request_id,
+                                                                request)
+
+        (brokers, topics) = KafkaProtocol.decode_metadata_response(response)
+        self._update_metadata(brokers, topics)
+
+    @asyncio.coroutine
+    def send_produce_request(self, payloads=[], acks=1, timeout=1000,
+                             fail_on_error=True, callback=None):
+        encoder = partial(KafkaProtocol.encode_produce_request,
+                          acks=acks, timeout=timeout)
+
+        if acks == 0:
+            decoder = None
+        else:
+            decoder = KafkaProtocol.decode_produce_response
+
+        resps = yield from self._send_broker_aware_request(payloads, encoder,
+                                                           decoder)
+        return self._handle_responses(resps, fail_on_error, callback)
+
+    @asyncio.coroutine
+    def send_fetch_request(self, payloads=[], fail_on_error=True,
+                           callback=None, max_wait_time=100, min_bytes=4096):
+        encoder = partial(KafkaProtocol.encode_fetch_request,
+                          max_wait_time=max_wait_time,
+                          min_bytes=min_bytes)
+
+        resps = yield from self._send_broker_aware_request(
+            payloads, encoder, KafkaProtocol.decode_fetch_response)
+        return self._handle_responses(resps, fail_on_error, callback)
+
+    @asyncio.coroutine
+    def send_offset_request(self, payloads=[], fail_on_error=True,
+                            callback=None):
+        resps = yield from self._send_broker_aware_request(
+            payloads,
+            KafkaProtocol.encode_offset_request,
+            KafkaProtocol.decode_offset_response)
+        return self._handle_responses(resps, fail_on_error, callback)
+
+    @asyncio.coroutine
+    def send_offset_commit_request(self, group, payloads=[],
+                                   fail_on_error=True, callback=None):
+        encoder = partial(KafkaProtocol.encode_offset_commit_request,
+                          group=group)
+        decoder = KafkaProtocol.decode_offset_commit_response
+        resps = yield from self._send_broker_aware_request(payloads, encoder,
+                                                           decoder)
+        return self._handle_responses(resps, fail_on_error, callback)
+
+    @asyncio.coroutine
+    def send_offset_fetch_request(self, group, payloads=[],
+                                  fail_on_error=True, callback=None):
+        encoder = partial(KafkaProtocol.encode_offset_fetch_request,
+                          group=group)
+        decoder = KafkaProtocol.decode_offset_fetch_response
+        resps = yield from self._send_broker_aware_request(payloads, encoder,
+                                                           decoder)
+        return self._handle_responses(resps, fail_on_error, callback)
+
+
+class AIOSimpleProducer(object):
+    """
+    A round-robin producer for AIOKafkaClient
+
+    client - The AIOKafkaClient instance to use
+    req_acks - A value indicating the acknowledgements that the server must
+               receive before responding to the request
+    ack_timeout - Value (in milliseconds) indicating a timeout for waiting
+                  for an acknowledgement
+    codec - CODEC_NONE (default), CODEC_GZIP or CODEC_SNAPPY
+    random_start - If true, randomize the initial partition each topic is
+                   published to
+    """
+    ACK_NOT_REQUIRED = Producer.ACK_NOT_REQUIRED
+    ACK_AFTER_LOCAL_WRITE = Producer.ACK_AFTER_LOCAL_WRITE
+    ACK_AFTER_CLUSTER_COMMIT = Producer.ACK_AFTER_CLUSTER_COMMIT
+
+    DEFAULT_ACK_TIMEOUT = Producer.DEFAULT_ACK_TIMEOUT
+
+    def __init__(self, client, req_acks=ACK_AFTER_LOCAL_WRITE,
+                 ack_timeout=DEFAULT_ACK_TIMEOUT, codec=None,
+                 random_start=False):
+        if codec is None:
+            codec = CODEC_NONE
+        elif codec not in ALL_CODECS:
+            raise UnsupportedCodecError("Codec 0x%02x unsupported" % codec)
+
+        self.client = client
+        self.req_acks = req_acks
+        self.ack_timeout = ack_timeout
+        self.codec = codec
+        self.random_start = random_start
+        self.partition_cycles = {}
+
+    def __repr__(self):
+        return '<AIOSimpleProducer>'
+
+    @asyncio.coroutine
+    def _next_partition(self, topic):
+        if topic not in self.partition_cycles:
+            if not self.client.has_metadata_for_topic(topic):
+                yield from self.client.load_metadata_for_topics(topic)
+            partitions = self.client.topic_partitions[topic]
+            self.partition_cycles[topic] = cycle(partitions)
+
+            if self.random_start:
+                for _ in range(random.randint(0, len(partitions) - 1)):
+                    next(self.partition_cycles[topic])
+
+        return next(self.partition_cycles[topic])
+
+    @asyncio.coroutine
+    def send_messages(self, topic, *msg):
+        """
+        Send messages to the next partition of topic, returning the list of
+        ProduceResponse
+        """
+        partition = yield from self._next_partition(topic)
+        messages = create_message_set(msg, self.codec)
+        req = ProduceRequest(topic, partition, messages)
+        return (yield from self.client.send_produce_request(
+            [req], acks=self.req_acks, timeout=self.ack_timeout))
+
+
+class AIOSimpleConsumer(object):
+    """
+    A consumer of all/specified partitions of a topic for AIOKafkaClient
+
+    client: an AIOKafkaClient
+    group: a name for this consumer, used for offset storage
+    topic: the topic to consume
+    partitions: an optional list of partitions to consume the data from
+    auto_commit: default True. Whether or not to commit the offsets
+    auto_commit_every_n: default 100. How many messages to consume
+                         before a commit
+    fetch_size_bytes: minimum number of bytes to request in a FetchRequest
+    buffer_size: default 4K. Initial number of bytes to tell kafka we have
+                 available. This will double as needed.
+    max_buffer_size: default 32K. Max number of bytes to tell kafka we have
+                     available. None means no limit.
+
+    Offsets are fetched from Kafka on the first call to get_messages.
+    """
+    def __init__(self, client, group, topic, partitions=None,
+                 auto_commit=True, auto_commit_every_n=AUTO_COMMIT_MSG_COUNT,
+                 fetch_size_bytes=FETCH_MIN_BYTES,
+                 buffer_size=FETCH_BUFFER_SIZE_BYTES,
+                 max_buffer_size=MAX_FETCH_BUFFER_SIZE_BYTES):
+        if max_buffer_size is not None and buffer_size > max_buffer_size:
+            raise ValueError("buffer_size (%d) is greater than "
+                             "max_buffer_size (%d)" %
+                             (buffer_size, max_buffer_size))
+        self.client = client
+        self.group = group
+        self.topic = topic
+        self.partitions = partitions
+        self.auto_commit = auto_commit
+        self.auto_commit_every_n = auto_commit_every_n
+        self.fetch_min_bytes = fetch_size_bytes
+        self.fetch_max_wait_time = FETCH_MAX_WAIT_TIME
+        self.buffer_size = buffer_size
+        self.max_buffer_size = max_buffer_size
+        self.offsets = None
+        self.count_since_commit = 0
+        self.queue = collections.deque()
+
+    def __repr__(self):
+        return '<AIOSimpleConsumer group=%s, topic=%s>' % (self.group,
+                                                           self.topic)
+
+    @asyncio.coroutine
+    def _load_offsets(self):
+        yield from self.client.load_metadata_for_topics(self.topic)
+        partitions = self.partitions
+        if not partitions:
+            partitions = self.client.topic_partitions[self.topic]
+
+        if not self.auto_commit:
+            self.offsets = dict((p, 0) for p in partitions)
+            return
+
+        def get_or_init_offset_callback(resp):
+            try:
+                kafka.common.check_error(resp)
+                return resp.offset
+            except UnknownTopicOrPartitionError:
+                return 0
+
+        reqs = [OffsetFetchRequest(self.topic, p) for p in partitions]
+        offsets = yield from self.client.send_offset_fetch_request(
+            self.group, reqs, callback=get_or_init_offset_callback,
+            fail_on_error=False)
+        self.offsets = dict(zip(partitions, offsets))
+
+    @asyncio.coroutine
+    def _fetch(self):
+        partitions = list(self.offsets.keys())
+        while partitions:
+            requests = [FetchRequest(self.topic, p, self.offsets[p],
+                                     self.buffer_size)
+                        for p in partitions]
+            responses = yield from self.client.send_fetch_request(
+                requests, max_wait_time=self.fetch_max_wait_time,
+                min_bytes=self.fetch_min_bytes)
+
+            retry_partitions = []
+            for resp in responses:
+                try:
+                    for message in resp.messages:
+                        self.queue.append((resp.partition, message))
+                except ConsumerFetchSizeTooSmall:
+                    buffer_size = _grown_buffer_size(self.buffer_size,
+                                                     self.max_buffer_size)
+                    if buffer_size is None:
+                        log.error("Max fetch size %d too small",
+                                  self.max_buffer_size)
+                        raise
+                    self.buffer_size = buffer_size
+                    log.warning("Fetch size too small, increase to %d (2x) "
+                                "and retry", self.buffer_size)
+                    retry_partitions.append(resp.partition)
+            partitions = retry_partitions
+
+    @asyncio.coroutine
+    def get_messages(self, count=1):
+        """
+        Fetch up to `count` messages, returning a list of OffsetAndMessage
+
+        Fetches only when no messages are left from the previous fetch.
+        A partition whose next message is larger than the buffer size is
+        fetched again with a buffer twice as large, up to max_buffer_size.
+        The list is empty if no messages arrived within the fetch max wait
+        time.
+        """
+        if self.offsets is None:
+            yield from self._load_offsets()
+
+        if not self.queue:
+            yield from self._fetch()
+
+        messages = []
+        while self.queue and len(messages) < count:
+            partition, message = self.queue.popleft()
+            self.offsets[partition] = message.offset + 1
+            messages.append(message)
+
+        self.count_since_commit += len(messages)
+        if (self.auto_commit and self.auto_commit_every_n is not None and
+                self.count_since_commit >= self.auto_commit_every_n):
+            yield from self.commit()
+
+        return messages
+
+    @asyncio.coroutine
+    def commit(self):
+        """
+        Commit the offsets of the messages returned so far
+        """
+        if self.count_since_commit == 0 or self.offsets is None:
+            return
+
+        reqs = [OffsetCommitRequest(self.topic, partition, offset, None)
+                for partition, offset in self.offsets.items()]
+        yield from self.client.send_offset_commit_request(self.group, reqs)
+        self.count_since_commit = 0
+
+    @asyncio.coroutine
+    def stop(self):
+        if self.auto_commit:
+            yield from self.commit()
@@ -1,24 +1,308 @@
 import copy
+import json
 import logging
 import collections
+import os
+import tempfile
+import time
 from functools import partial
 from itertools import count
+from threading import Event, Lock
+
+try:
+    import selectors
+except ImportError:
+    selectors = None
 
 import kafka.common
-from kafka.common import (TopicAndPartition,
+from kafka.common import (TopicAndPartition, BrokerMetadata,
                           ConnectionError, FailedPayloadsError,
                           PartitionUnavailableError,
                           LeaderUnavailableError, KafkaUnavailableError,
                           UnknownTopicOrPartitionError, NotLeaderForPartitionError)
-from kafka.conn import collect_hosts, KafkaConnection, DEFAULT_SOCKET_TIMEOUT_SECONDS
+from kafka.conn import (collect_hosts, KafkaConnectionPool,
+                        DEFAULT_SOCKET_TIMEOUT_SECONDS, DEFAULT_POOL_SIZE,
+                        DEFAULT_CONNECT_TIMEOUT_SECONDS,
+                        DEFAULT_RECONNECT_BACKOFF_SECONDS,
+                        DEFAULT_MAX_RECONNECT_BACKOFF_SECONDS)
+from kafka.metrics import ConnectionMetrics
 from kafka.protocol import KafkaProtocol
+from kafka.util import ReentrantTimer
 from kafka import compat
 
 
 log = logging.getLogger("kafka")
 
 
-class KafkaClient(object):
+class _MetadataLoad(object):
+    """
+    A metadata request in progress, which other threads needing the same
+    metadata wait for instead of sending their own
+    """
+    def __init__(self):
+        self.done = Event()
+        self.error = None
+
+
+class _ProduceBatch(object):
+    """
+    Payloads of concurrent produce calls sent together as one request
+    """
+    def __init__(self):
+        self.payloads = []
+        self.keys = set()       # (topic, partition) of the payloads
+        self.done = Event()
+        self.responses = {}     # (topic, partition) -> response
+        self.attempted = set()  # (topic, partition) of payloads sent
+        self.error = None
+
+
+class _ProduceCoalescer(object):
+    """
+    Merges the payloads of produce calls made within `window` seconds of
+    each other into a single call
+
+    The first caller waits for the window to pass, sends the payloads of
+    every caller that joined meanwhile, and hands each caller back the
+    responses to its own payloads. Calls only share a batch if they use
+    the same acks and timeout, and a partition never appears twice in a
+    batch, since a request holds a single message set per partition.
+
+    If sending the batch fails, each caller only sees how its own payloads
+    fared: the responses to them, a FailedPayloadsError listing those of
+    them that failed, or the error if they were sent but not answered.
+    Payloads the batch failed before sending, say because another caller
+    produced to an unknown topic, are sent again on their own.
+    """
+    def __init__(self, window):
+        self.window = window
+        self._lock = Lock()
+        self._open = {}    # (acks, timeout) -> _ProduceBatch
+
+    def send(self, send_fn, payloads, acks, timeout):
+        """
+        Send payloads as part of a batch with send_fn, which must accept a
+        list of payloads and a set, add the (topic, partition) of every
+        payload it tries to send to the set, and return or yield the
+        responses in any order
+        """
+        key = (acks, timeout)
+        payload_keys = [(p.topic, p.partition) for p in payloads]
+
+        with self._lock:
+            batch = self._open.get(key)
+            sender = batch is None or not batch.keys.isdisjoint(payload_keys)
+            if sender:
+                batch = self._open[key] = _ProduceBatch()
+            batch.payloads.extend(payloads)
+            batch.keys.update(payload_keys)
+
+        if sender:
+            # Whatever happens, even an interrupt while waiting out the
+            # window, the callers that joined must be let go
+            try:
+                time.sleep(self.window)
+                self._close(key, batch)
+                self._collect(batch.responses,
+                              send_fn(batch.payloads, batch.attempted))
+            except BaseException as e:
+                batch.error = e
+                if not isinstance(e, Exception):
+                    raise
+            finally:
+                self._close(key, batch)
+                batch.done.set()
+        else:
+            batch.done.wait()
+
+        responses = batch.responses
+        error = batch.error
+        if isinstance(error, FailedPayloadsError):
+            failed = set((p.topic, p.partition) for p in error.args[0])
+            own_failed = [p for (p, k) in zip(payloads, payload_keys)
+                          if k in failed]
+            if own_failed:
+                raise FailedPayloadsError(own_failed)
+        elif error is not None:
+            unanswered = [(p, k) for (p, k) in zip(payloads, payload_keys)
+                          if k not in responses]
+            if any(k in batch.attempted for (p, k) in unanswered):
+                raise error
+            if unanswered:
+                responses = dict(responses)
+                self._collect(responses, send_fn(
+                    [p for (p, k) in unanswered], set()))
+
+        return [responses[k] for k in payload_keys if k in responses]
+
+    def _close(self, key, batch):
+        "Stop other callers from joining batch, if it is still open"
+        with self._lock:
+            if self._open.get(key) is batch:
+                del self._open[key]
+
+    @staticmethod
+    def _collect(acc, responses):
+        for response in responses:
+            acc[(response.topic, response.partition)] = response
+
+
+class _ClientMetadata(object):
+    """
+    The cluster metadata requests are routed by, and everything done with
+    it that involves no I/O, shared by KafkaClient and AIOKafkaClient
+
+    Subclasses call _init_metadata on construction, send the requests, and
+    hand each decoded MetadataResponse to _update_metadata.
+    """
+    def _init_metadata(self):
+        self.brokers = {}            # broker_id -> BrokerMetadata
+        self.topics_to_brokers = {}  # topic_id -> broker_id
+        self.topic_partitions = {}   # topic_id -> [0, 1, 2, ...]
+        self.topics_loaded_at = {}   # topic_id -> time.time() of last load
+        self._metadata_version = 0   # bumped by _metadata_changed
+        self._metadata_shared = False  # metadata dicts shared with a copy
+
+    def _own_metadata(self):
+        """
+        Must be called before changing the metadata dicts in place: if they
+        are shared with a copy of the client, take private copies of them
+        first
+        """
+        if self._metadata_shared:
+            self.topics_to_brokers = dict(self.topics_to_brokers)
+            self.topic_partitions = dict(self.topic_partitions)
+            self.topics_loaded_at = dict(self.topics_loaded_at)
+            self._metadata_shared = False
+
+    def _metadata_changed(self):
+        """
+        Must be called after changing topics_to_brokers in place, so the
+        routing index is rebuilt
+        """
+        self._metadata_version += 1
+
+    def _update_metadata(self, brokers, topics):
+        """
+        Replace the metadata of the topics of a decoded MetadataResponse
+
+        The new metadata is built aside and swapped in at once, so other
+        threads never see a topic missing while it is being reloaded.
+        """
+        log.debug("Broker metadata: %s", brokers)
+        log.debug("Topic metadata: %s", topics)
+
+        loaded_at = time.time()
+        topics_to_brokers = dict(self.topics_to_brokers)
+        topic_partitions = dict(self.topic_partitions)
+        topics_loaded_at = dict(self.topics_loaded_at)
+
+        for topic, partitions in topics.items():
+            for partition in topic_partitions.pop(topic, ()):
+                topics_to_brokers.pop(TopicAndPartition(topic, partition), None)
+            topics_loaded_at.pop(topic, None)
+
+            if not partitions:
+                log.warning('No partitions for %s', topic)
+                continue
+
+            topics_loaded_at[topic] = loaded_at
+
+            topic_partitions[topic] = []
+            for partition, meta in partitions.items():
+                topic_partitions[topic].append(partition)
+                topic_part = TopicAndPartition(topic, partition)
+                if meta.leader == -1:
+                    log.warning('No leader for topic %s partition %s', topic, partition)
+                    topics_to_brokers[topic_part] = None
+                else:
+                    topics_to_brokers[topic_part] = brokers[meta.leader]
+
+        self.brokers = brokers
+        (self.topics_to_brokers, self.topic_partitions,
+         self.topics_loaded_at) = (topics_to_brokers, topic_partitions,
+                                   topics_loaded_at)
+        self._metadata_shared = False  # the new dicts are ours alone
+        self._metadata_changed()
+
+    def _known_leader(self, topic, partition):
+        """
+        The leader of a partition in the metadata as it is, None if the
+        partition has no leader
+
+        PartitionUnavailableError will be raised if the topic or partition
+        is not part of the metadata.
+        """
+        key = TopicAndPartition(topic, partition)
+        try:
+            return self.topics_to_brokers[key]
+        except KeyError:
+            raise PartitionUnavailableError("%s not available" % str(key))
+
+    def _raise_on_response_error(self, resp):
+        try:
+            kafka.common.check_error(resp)
+        except (UnknownTopicOrPartitionError, NotLeaderForPartitionError) as e:
+            self.reset_topic_metadata(resp.topic)
+            raise
+
+    def _handle_responses(self, resps, fail_on_error, callback):
+        """
+        Check the responses for errors if fail_on_error is set, and pass
+        them through callback if there is one
+        """
+        out = []
+        for resp in resps:
+            if fail_on_error is True:
+                self._raise_on_response_error(resp)
+
+            if callback is not None:
+                out.append(callback(resp))
+            else:
+                out.append(resp)
+        return out
+
+    def reset_topic_metadata(self, *topics):
+        self._own_metadata()
+        for topic in topics:
+            try:
+                partitions = self.topic_partitions[topic]
+            except KeyError:
+                continue
+
+            for partition in partitions:
+                self.topics_to_brokers.pop(TopicAndPartition(topic, partition), None)
+
+            del self.topic_partitions[topic]
+            self.topics_loaded_at.pop(topic, None)
+            self._metadata_changed()
+
+    def reset_broker_metadata(self, *brokers):
+        """
+        Forget the leader of every partition led by one of the given
+        brokers, and return the sorted list of topics affected
+        """
+        self._own_metadata()
+        topics = set()
+        for topic_part, leader in list(self.topics_to_brokers.items()):
+            if leader is not None and leader in brokers:
+                del self.topics_to_brokers[topic_part]
+                topics.add(topic_part.topic)
+        self._metadata_changed()
+        return sorted(topics)
+
+    def reset_all_metadata(self):
+        self._own_metadata()
+        self.topics_to_brokers.clear()
+        self.topic_partitions.clear()
+        self.topics_loaded_at.clear()
+        self._metadata_changed()
+
+    def has_metadata_for_topic(self, topic):
+        return topic in self.topic_partitions
+
+
+class KafkaClient(_ClientMetadata):
 
     CLIENT_ID = "kafka-python"
     ID_GEN = count()
@@ -26,37 +310,134 @@ class KafkaClient(object):
     # NOTE: The timeout given to the client should always be greater than the
     # one passed to SimpleConsumer.get_message(), otherwise you can get a
     # socket timeout.
+    #
+    # pool_size bounds the number of connections opened to each broker by
+    # all threads sharing the client. socket_options is a list of
+    # (level, option, value) tuples set on every broker socket, see
+    # KafkaConnection.
+    #
+    # connect_timeout bounds how long connecting to a dead broker blocks.
+    # A broker that fails is not contacted again for reconnect_backoff
+    # seconds, doubling with every further failure up to
+    # max_reconnect_backoff; bootstrap requests try other hosts first.
+    #
+    # With metrics=True, I/O counters and latency histograms are kept for
+    # each broker and can be read with get_metrics(). They cost nothing
+    # when left off.
+    #
+    # Topic metadata is kept until a request fails unless metadata_max_age
+    # is set, in which case it is reloaded on first use after that many
+    # seconds. metadata_refresh_interval reloads the metadata of every
+    # known topic in the background every that many seconds. Threads
+    # needing the same metadata at the same time share a single request.
+    #
+    # By default the metadata of the whole cluster is loaded up front. With
+    # bootstrap_metadata=False nothing is loaded until a topic is first
+    # used, and then only the metadata of that topic.
+    #
+    # metadata_snapshot names a file the metadata is saved to after every
+    # load and read back from at startup instead of asking the cluster,
+    # so short-lived processes start warm. Leaders read from the file are
+    # trusted until a request to them fails, like any other metadata.
+    #
+    # When a broker fails, its payloads are resent up to retries times to
+    # the new leaders of their partitions, after retry_backoff seconds,
+    # doubling each time. By default FailedPayloadsError is raised at once.
+    #
+    # produce_coalesce_window (seconds) lets send_produce_request calls
+    # made by different threads within that window share one request per
+    # broker. Off by default, as it delays every produce by the window.
     def __init__(self, hosts, client_id=CLIENT_ID,
-                 timeout=DEFAULT_SOCKET_TIMEOUT_SECONDS):
+                 timeout=DEFAULT_SOCKET_TIMEOUT_SECONDS,
+                 pool_size=DEFAULT_POOL_SIZE,
+                 socket_options=None,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT_SECONDS,
+                 reconnect_backoff=DEFAULT_RECONNECT_BACKOFF_SECONDS,
+                 max_reconnect_backoff=DEFAULT_MAX_RECONNECT_BACKOFF_SECONDS,
+                 metrics=False,
+                 metadata_max_age=None,
+                 metadata_refresh_interval=None,
+                 bootstrap_metadata=True,
+                 metadata_snapshot=None,
+                 retries=0,
+                 retry_backoff=0.1,
+                 produce_coalesce_window=None):
         # We need one connection to bootstrap
         self.client_id = client_id
         self.timeout = timeout
+        self.pool_size = pool_size
+        self.socket_options = socket_options
+        self.connect_timeout = connect_timeout
+        self.reconnect_backoff = reconnect_backoff
+        self.max_reconnect_backoff = max_reconnect_backoff
+        self.metrics = metrics
+        self.metadata_max_age = metadata_max_age
+        self.metadata_refresh_interval = metadata_refresh_interval
+        self.metadata_snapshot = metadata_snapshot
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.produce_coalesce_window = produce_coalesce_window
         self.hosts = collect_hosts(hosts)
 
         # create connections only when we need them
-        self.conns = {}
-        self.brokers = {}            # broker_id -> BrokerMetadata
-        self.topics_to_brokers = {}  # topic_id -> broker_id
-        self.topic_partitions = {}   # topic_id -> [0, 1, 2, ...]
-        self.load_metadata_for_topics()  # bootstrap with all metadata
+        self.conns = {}              # (host, port) -> KafkaConnectionPool
+        self._init_metadata()
+        self._routes = (None, None, {})  # (version, source, routing index)
+        self._metadata_lock = Lock()
+        self._metadata_loads = {}    # tuple of topics -> _MetadataLoad
+        self._refresh_timer = None
+        self._produce_coalescer = None
+        if produce_coalesce_window is not None:
+            self._produce_coalescer = _ProduceCoalescer(produce_coalesce_window)
+        # a snapshot, if any, stands in for the bootstrap
+        if not self._load_metadata_snapshot() and bootstrap_metadata:
+            self.load_metadata_for_topics()  # bootstrap with all metadata
+        self._start_refresh_timer()
 
 
     ##################
     #   Private API  #
     ##################
 
-    def _get_conn(self, host, port):
-        "Get or create a connection to a broker using host and port"
+    def _get_pool(self, host, port):
+        "Get or create the connection pool for a broker using host and port"
         host_key = (host, port)
         if host_key not in self.conns:
-            self.conns[host_key] = KafkaConnection(
+            self.conns.setdefault(host_key, KafkaConnectionPool(
                 host,
                 port,
-                timeout=self.timeout
-            )
+                timeout=self.timeout,
+                size=self.pool_size,
+                socket_options=self.socket_options,
+                connect_timeout=self.connect_timeout,
+                reconnect_backoff=self.reconnect_backoff,
+                max_reconnect_backoff=self.max_reconnect_backoff,
+                metrics=ConnectionMetrics() if self.metrics else None
+            ))
 
         return self.conns[host_key]
 
+    def _get_conn(self, host, port):
+        """
+        Check out a connection to a broker using host and port. It must be
+        handed back with _release_conn once the request is done.
+        """
+        return self._get_pool(host, port).checkout()
+
+    def _release_conn(self, host, port, conn, failed=False):
+        """
+        Check a connection obtained from _get_conn back in to its pool,
+        telling whether the broker failed to handle the request
+        """
+        pool = self.conns.get((host, port))
+        if pool is not None:
+            pool.checkin(conn, failed)
+
+    def _in_backoff(self, host, port):
+        "Whether the broker at host and port failed recently"
+        pool = self.conns.get((host, port))
+        return pool is not None and pool.in_backoff()
+
     def _get_leader_for_partition(self, topic, partition):
         """
         Returns the leader for a partition or None if the partition exists
@@ -67,15 +448,176 @@ class KafkaClient(object):
         """
 
         key = TopicAndPartition(topic, partition)
-        # reload metadata whether the partition is not available
-        # or has no leader (broker is None)
-        if self.topics_to_brokers.get(key) is None:
+        # reload metadata whether the partition is not available,
+        # has no leader (broker is None) or is too old
+        if (self.topics_to_brokers.get(key) is None or
+                self._metadata_expired(topic)):
             self.load_metadata_for_topics(topic)
 
-        if key not in self.topics_to_brokers:
-            raise PartitionUnavailableError("%s not available" % str(key))
+        return self._known_leader(topic, partition)
+
+    def _get_routes(self):
+        """
+        The routing index, a dict of topic -> {partition: leader}
+
+        It is rebuilt from topics_to_brokers when the metadata has changed
+        since it was last built, and shared otherwise.
+        """
+        (version, source, routes) = self._routes
+        if version != self._metadata_version or \
+                source is not self.topics_to_brokers:
+            version = self._metadata_version
+            source = self.topics_to_brokers
+            routes = {}
+            for (topic, partition), leader in list(source.items()):
+                routes.setdefault(topic, {})[partition] = leader
+            self._routes = (version, source, routes)
+        return routes
+
+    def _group_by_leader(self, payloads):
+        """
+        Group payloads into a dict of leader -> [payload, ...], loading the
+        metadata of partitions with no known leader
+
+        Raises LeaderUnavailableError if a partition has no leader.
+        """
+        routes = self._get_routes()
+        check_age = self.metadata_max_age is not None
+        payloads_by_broker = {}
+
+        for payload in payloads:
+            partitions = routes.get(payload.topic)
+            leader = partitions.get(payload.partition) if partitions else None
+            if leader is None or (check_age and
+                                  self._metadata_expired(payload.topic)):
+                leader = self._get_leader_for_partition(payload.topic,
+                                                        payload.partition)
+                routes = self._get_routes()
+                if leader is None:
+                    raise LeaderUnavailableError(
+                        "Leader not available for topic %s partition %s" %
+                        (payload.topic, payload.partition))
+
+            group = payloads_by_broker.get(leader)
+            if group is None:
+                group = payloads_by_broker[leader] = []
+            group.append(payload)
+
+        return payloads_by_broker
+
+    def _metadata_expired(self, topic):
+        "Whether the metadata of topic is older than metadata_max_age"
+        if self.metadata_max_age is None:
+            return False
+        loaded_at = self.topics_loaded_at.get(topic, 0)
+        return time.time() - loaded_at > self.metadata_max_age
+
+    def _start_refresh_timer(self):
+        if self.metadata_refresh_interval is None:
+            return
+        if self._refresh_timer is None:
+            self._refresh_timer = ReentrantTimer(
+                self.metadata_refresh_interval * 1000,
+                self._refresh_metadata)
+        self._refresh_timer.start()
+
+    def _stop_refresh_timer(self):
+        if self._refresh_timer is not None:
+            self._refresh_timer.stop()
+
+    def _refresh_metadata(self):
+        """
+        Reload the metadata of every known topic, from the refresh timer
+        """
+        topics = list(self.topic_partitions.keys())
+        if not topics:
+            return
+
+        try:
+            self.load_metadata_for_topics(*topics)
+        except Exception as e:
+            log.warning("Background metadata refresh failed: %s", e)
+
+    def _save_metadata_snapshot(self):
+        """
+        Write the brokers and topic leaders to the metadata_snapshot file
+
+        The file is replaced atomically, so readers never see a partial
+        snapshot. Failing to write it is logged and otherwise ignored.
+        """
+        if self.metadata_snapshot is None:
+            return
+
+        topics = {}
+        for topic, partitions in list(self.topic_partitions.items()):
+            leaders = topics[topic] = {}
+            for partition in partitions:
+                leader = self.topics_to_brokers.get(
+                    TopicAndPartition(topic, partition))
+                leaders[str(partition)] = -1 if leader is None else leader.nodeId
+
+        snapshot = {
+            'version': 1,
+            'saved_at': time.time(),
+            'brokers': [list(broker) for broker in self.brokers.values()],
+            'topics': topics,
+        }
+
+        directory = os.path.dirname(os.path.abspath(self.metadata_snapshot))
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(snapshot, f)
+                getattr(os, 'replace', os.rename)(tmp_path,
+                                                  self.metadata_snapshot)
+            except Exception:
+                os.unlink(tmp_path)
+                raise
+        except (IOError, OSError) as e:
+            log.warning("Unable to save metadata snapshot to %s: %s",
+                        self.metadata_snapshot, e)
+
+    def _load_metadata_snapshot(self):
+        """
+        Fill in the metadata from the metadata_snapshot file, returning
+        whether it could be read
+        """
+        if self.metadata_snapshot is None:
+            return False
 
-        return self.topics_to_brokers[key]
+        try:
+            with open(self.metadata_snapshot) as f:
+                snapshot = json.load(f)
+            if snapshot.get('version') != 1:
+                raise ValueError('unknown version %r' % snapshot.get('version'))
+
+            brokers = {}
+            for (node_id, host, port) in snapshot['brokers']:
+                brokers[node_id] = BrokerMetadata(node_id, str(host), port)
+
+            topic_partitions = {}
+            topics_to_brokers = {}
+            for topic, leaders in snapshot['topics'].items():
+                topic = str(topic)
+                topic_partitions[topic] = []
+                for partition, leader in leaders.items():
+                    partition = int(partition)
+                    topic_partitions[topic].append(partition)
+                    topics_to_brokers[TopicAndPartition(topic, partition)] = \
+                        None if leader == -1 else brokers[leader]
+        except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+            log.info("Not using metadata snapshot %s: %s",
+                     self.metadata_snapshot, e)
+            return False
+
+        self.brokers = brokers
+        self.topic_partitions = topic_partitions
+        self.topics_to_brokers = topics_to_brokers
+        self.topics_loaded_at = dict.fromkeys(topic_partitions,
+                                              snapshot['saved_at'])
+        self._metadata_changed()
+        return True
 
     def _next_id(self):
         """
@@ -88,15 +630,24 @@ class KafkaClient(object):
         Attempt to send a broker-agnostic request to one of the available
         brokers. Keep trying until you succeed.
         """
-        for (host, port) in self.hosts:
+        # Route around hosts that failed recently, they are tried last
+        hosts = sorted(self.hosts, key=lambda h: self._in_backoff(*h))
+
+        for (host, port) in hosts:
+            conn = None
+            failed = False
             try:
                 conn = self._get_conn(host, port)
                 conn.send(requestId, request)
                 response = conn.recv(requestId)
                 return response
             except Exception as e:
+                failed = True
                 log.warning("Could not send request [%r] to server %s:%i, "
                             "trying next server: %s" % (request, host, port, e))
+            finally:
+                if conn is not None:
+                    self._release_conn(host, port, conn, failed)
 
         raise KafkaUnavailableError("All servers failed to process request")
 
@@ -120,122 +671,304 @@ class KafkaClient(object):
         Return
         ======
         List of response objects in the same order as the supplied payloads
-        """
-
-        # Group the requests by topic+partition
-        original_keys = []
-        payloads_by_broker = collections.defaultdict(list)
 
-        for payload in payloads:
-            leader = self._get_leader_for_partition(payload.topic,
-                                                    payload.partition)
-            if leader is None:
-                raise LeaderUnavailableError(
-                    "Leader not available for topic %s partition %s" %
-                    (payload.topic, payload.partition))
+        Payloads that could not reach their leader are retried up to
+        `retries` times, see KafkaClient.
+        """
 
-            payloads_by_broker[leader].append(payload)
-            original_keys.append((payload.topic, payload.partition))
+        original_keys = [(payload.topic, payload.partition)
+                         for payload in payloads]
 
         # Accumulate the responses in a dictionary
         acc = {}
+        for response in self._iter_broker_aware_request(payloads, encoder_fn,
+                                                        decoder_fn):
+            acc[(response.topic, response.partition)] = response
 
-        # keep a list of payloads that were failed to be sent to brokers
-        failed_payloads = []
+        # Order the accumulated responses by the original key order
+        return (acc[k] for k in original_keys) if acc else ()
 
-        # For each broker, send the list of request payloads
-        for broker, payloads in payloads_by_broker.items():
-            conn = self._get_conn(broker.host, broker.port)
-            requestId = self._next_id()
-            request = encoder_fn(client_id=self.client_id,
-                                 correlation_id=requestId, payloads=payloads)
+    def _iter_broker_aware_request(self, payloads, encoder_fn, decoder_fn):
+        """
+        Like _send_broker_aware_request, but yield the response objects as
+        the response of each broker is read, in no particular order
 
-            failed = False
-            # Send the request, recv the response
+        Payloads that failed are retried once everything else has been
+        yielded. FailedPayloadsError is raised at the end if any are left.
+        """
+        # Resend whatever failed, to the leaders as they are after the
+        # metadata of the failed brokers was refreshed
+        attempt = 0
+        while True:
+            failed_payloads = []
             try:
-                conn.send(requestId, request)
-                if decoder_fn is None:
-                    continue
+                for response in self._send_to_leaders(
+                        payloads, encoder_fn, decoder_fn, failed_payloads):
+                    yield response
+            except LeaderUnavailableError:
+                # A leader election is under way, nothing was sent
+                if attempt >= self.retries:
+                    raise
+                failed_payloads = payloads
+
+            if not failed_payloads:
+                return
+            if attempt >= self.retries:
+                raise FailedPayloadsError(failed_payloads)
+
+            backoff = self.retry_backoff * 2 ** attempt
+            attempt += 1
+            log.info("Retrying %d payload(s) in %.3fs, attempt %d of %d",
+                     len(failed_payloads), backoff, attempt, self.retries)
+            time.sleep(backoff)
+            payloads = failed_payloads
+
+    def _send_to_leaders(self, payloads, encoder_fn, decoder_fn,
+                         failed_payloads):
+        """
+        Send the payloads to the leaders of their partitions and yield the
+        decoded response objects as they are read. Payloads that could not
+        be sent or whose responses could not be read are added to
+        failed_payloads.
+        """
+        payloads_by_broker = self._group_by_leader(payloads)
+
+        # For each broker, send the list of request payloads. All requests
+        # are sent before any response is read so that the brokers work
+        # on them concurrently
+        checked_out = {}  # broker -> connection
+        failed_brokers = set()
+        unread = set()    # brokers whose response has not been read
+        in_flight = []
+        try:
+            for broker, payloads in payloads_by_broker.items():
+                requestId = self._next_id()
+                request = encoder_fn(client_id=self.client_id,
+                                     correlation_id=requestId,
+                                     payloads=payloads)
+
+                conn = None
                 try:
-                    response = conn.recv(requestId)
+                    conn = self._get_conn(broker.host, broker.port)
+                    checked_out[broker] = conn
+                    conn.send(requestId, request)
                 except ConnectionError as e:
+                    log.warning("Could not send request [%s] to server %s: %s",
+                                request, conn or broker, e)
+                    failed_brokers.add(broker)
+                    failed_payloads += payloads
+                    continue
+
+                if decoder_fn is not None:
+                    in_flight.append((conn, requestId, request, payloads,
+                                      broker))
+                    unread.add(broker)
+
+            # Collect the responses in the order they arrive
+            for (conn, requestId, request, payloads, broker), response in \
+                    self._iter_responses(in_flight):
+                unread.discard(broker)
+                if isinstance(response, ConnectionError):
                     log.warning("Could not receive response to request [%s] "
-                                "from server %s: %s", request, conn, e)
-                    failed = True
-            except ConnectionError as e:
-                log.warning("Could not send request [%s] to server %s: %s",
-                            request, conn, e)
-                failed = True
+                                "from server %s: %s", request, conn, response)
+                    failed_brokers.add(broker)
+                    failed_payloads += payloads
+                    continue
 
-            if failed:
-                failed_payloads += payloads
-                self.reset_all_metadata()
-                continue
+                for response in decoder_fn(response):
+                    yield response
+        finally:
+            for broker, conn in checked_out.items():
+                if broker in unread:
+                    # Given up on before its response was read, which would
+                    # otherwise be left for the next user of the connection
+                    conn.close()
+                self._release_conn(broker.host, broker.port, conn,
+                                   broker in failed_brokers)
+
+        if failed_brokers:
+            self._refresh_metadata_for_brokers(failed_brokers)
+
+    def _refresh_metadata_for_brokers(self, brokers):
+        """
+        Forget which partitions the failed brokers lead and reload the
+        metadata of their topics with a single request, so that only those
+        topics are affected. If the reload fails, the partitions are left
+        to be reloaded when next used.
+        """
+        topics = self.reset_broker_metadata(*brokers)
+        if not topics:
+            return
 
-            for response in decoder_fn(response):
-                acc[(response.topic, response.partition)] = response
+        try:
+            self.load_metadata_for_topics(*topics)
+        except Exception as e:
+            log.warning("Could not refresh metadata for topics %s: %s",
+                        topics, e)
 
-        if failed_payloads:
-            raise FailedPayloadsError(failed_payloads)
+    def _iter_responses(self, in_flight):
+        """
+        Read the responses to requests sent to one or more brokers
+
+        in_flight is a list of tuples whose first two items are the
+        connection a request was sent on and its correlation id. Yields
+        (entry, response) for each of them as soon as its response can
+        be read, so the wait for several brokers is that of the slowest
+        one rather than the sum of them all. If a response cannot be read
+        the ConnectionError is yielded in its place.
+        """
+        waiting = collections.defaultdict(list)
+        for entry in in_flight:
+            conn, request_id = entry[0], entry[1]
+            if conn.has_response(request_id):
+                yield entry, conn.recv(request_id)
+            else:
+                waiting[conn].append(entry)
 
-        # Order the accumulated responses by the original key order
-        return (acc[k] for k in original_keys) if acc else ()
+        if selectors is None or len(waiting) < 2:
+            # Nothing to multiplex, read each response in turn
+            for conn, entries in waiting.items():
+                for entry in entries:
+                    yield entry, self._recv_or_error(conn, entry[1])
+            return
+
+        selector = selectors.DefaultSelector()
+        try:
+            for conn in waiting:
+                selector.register(conn, selectors.EVENT_READ)
+
+            while waiting:
+                ready = selector.select(self.timeout)
+                if not ready:
+                    # Nothing arrived within the socket timeout
+                    for conn, entries in waiting.items():
+                        conn.close()
+                        for entry in entries:
+                            yield entry, ConnectionError(
+                                "Timed out waiting for response from %r" %
+                                conn)
+                    return
+
+                for key, _ in ready:
+                    conn = key.fileobj
+                    selector.unregister(conn)
+                    for entry in waiting.pop(conn):
+                        yield entry, self._recv_or_error(conn, entry[1])
+        finally:
+            selector.close()
+
+    def _recv_or_error(self, conn, request_id):
+        """
+        Read a response, returning rather than raising a ConnectionError
+        """
+        try:
+            return conn.recv(request_id)
+        except ConnectionError as e:
+            return e
 
     def __repr__(self):
         return '<KafkaClient client_id=%s>' % (self.client_id)
 
-    def _raise_on_response_error(self, resp):
-        try:
-            kafka.common.check_error(resp)
-        except (UnknownTopicOrPartitionError, NotLeaderForPartitionError) as e:
-            self.reset_topic_metadata(resp.topic)
-            raise
-
     #################
     #   Public API  #
     #################
-    def reset_topic_metadata(self, *topics):
-        for topic in topics:
-            try:
-                partitions = self.topic_partitions[topic]
-            except KeyError:
-                continue
-
-            for partition in partitions:
-                self.topics_to_brokers.pop(TopicAndPartition(topic, partition), None)
-
-            del self.topic_partitions[topic]
-
-    def reset_all_metadata(self):
-        self.topics_to_brokers.clear()
-        self.topic_partitions.clear()
+    def get_metrics(self):
+        """
+        Snapshot of the I/O metrics of each broker connected to so far, as
+        a dict of (host, port) -> dict of counters and histogram summaries
+        (see kafka.metrics.ConnectionMetrics). Empty unless the client was
+        created with metrics=True.
+        """
+        return dict((host_key, pool.metrics.snapshot())
+                    for host_key, pool in self.conns.items()
+                    if pool.metrics is not None)
 
-    def has_metadata_for_topic(self, topic):
-        return topic in self.topic_partitions
+    def reset_metrics(self):
+        """
+        Zero the I/O metrics of every broker
+        """
+        for pool in self.conns.values():
+            if pool.metrics is not None:
+                pool.metrics.reset()
 
     def close(self):
-        for conn in self.conns.values():
-            conn.close()
+        self._stop_refresh_timer()
+        for pool in self.conns.values():
+            pool.close()
 
     def copy(self):
         """
         Create an inactive copy of the client object
-        A reinit() has to be done on the copy before it can be used again
+        The copy does not share any connection with this client. It shares
+        the metadata until either client changes it, so copying is equally
+        cheap whatever the size of the cluster.
         """
-        c = copy.deepcopy(self)
-        for k, v in self.conns.items():
-            c.conns[k] = v.copy()
-        return c
+        self._metadata_shared = True
+        return copy.copy(self)
 
     def reinit(self):
-        for conn in self.conns.values():
-            conn.reinit()
+        for pool in self.conns.values():
+            pool.reinit()
+        self._start_refresh_timer()
+
+    def __getstate__(self):
+        # Locks and threads can be neither copied nor pickled; copies get
+        # their own, and start refreshing metadata once reinit() is called.
+        # Connections are opened again as needed.
+        state = self.__dict__.copy()
+        state['conns'] = {}
+        del state['_metadata_lock']
+        state['_metadata_loads'] = {}
+        state['_refresh_timer'] = None
+        del state['_produce_coalescer']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._metadata_lock = Lock()
+        self._produce_coalescer = None
+        if self.produce_coalesce_window is not None:
+            self._produce_coalescer = _ProduceCoalescer(
+                self.produce_coalesce_window)
 
     def load_metadata_for_topics(self, *topics):
         """
         Discover brokers and metadata for a set of topics. This function is called
         lazily whenever metadata is unavailable.
+
+        If another thread is already loading metadata for the same topics,
+        or for more topics including them, wait for its request to complete
+        instead of sending another one.
         """
+        key = tuple(sorted(set(topics)))
+        with self._metadata_lock:
+            load = self._metadata_loads.get(key)
+            if load is None and key:
+                for loading, other in self._metadata_loads.items():
+                    if set(key).issubset(loading):
+                        load = other
+                        break
+            in_progress = load is not None
+            if not in_progress:
+                load = self._metadata_loads[key] = _MetadataLoad()
+
+        if in_progress:
+            load.done.wait()
+            if load.error is not None:
+                raise load.error
+            return
+
+        try:
+            self._load_metadata_for_topics(topics)
+        except Exception as e:
+            load.error = e
+            raise
+        finally:
+            with self._metadata_lock:
+                del self._metadata_loads[key]
+            load.done.set()
+
+    def _load_metadata_for_topics(self, topics):
         request_id = self._next_id()
         request = KafkaProtocol.encode_metadata_request(self.client_id,
                                                         request_id, topics)
@@ -243,28 +976,8 @@ class KafkaClient(object):
         response = self._send_broker_unaware_request(request_id, request)
 
         (brokers, topics) = KafkaProtocol.decode_metadata_response(response)
-
-        log.debug("Broker metadata: %s", brokers)
-        log.debug("Topic metadata: %s", topics)
-
-        self.brokers = brokers
-
-        for topic, partitions in topics.items():
-            self.reset_topic_metadata(topic)
-
-            if not partitions:
-                log.warning('No partitions for %s', topic)
-                continue
-
-            self.topic_partitions[topic] = []
-            for partition, meta in partitions.items():
-                self.topic_partitions[topic].append(partition)
-                topic_part = TopicAndPartition(topic, partition)
-                if meta.leader == -1:
-                    log.warning('No leader for topic %s partition %s', topic, partition)
-                    self.topics_to_brokers[topic_part] = None
-                else:
-                    self.topics_to_brokers[topic_part] = brokers[meta.leader]
+        self._update_metadata(brokers, topics)
+        self._save_metadata_snapshot()
 
     def send_produce_request(self, payloads=[], acks=1, timeout=1000,
                              fail_on_error=True, callback=None):
@@ -299,46 +1012,76 @@ class KafkaClient(object):
         else:
             decoder = KafkaProtocol.decode_produce_response
 
-        resps = self._send_broker_aware_request(payloads, encoder, decoder)
-
-        out = []
-        for resp in resps:
-            if fail_on_error is True:
-                self._raise_on_response_error(resp)
+        if self._produce_coalescer is not None:
+            def send(batch, attempted):
+                def encode(**kwargs):
+                    attempted.update((p.topic, p.partition)
+                                     for p in kwargs['payloads'])
+                    return encoder(**kwargs)
+                return self._iter_broker_aware_request(batch, encode, decoder)
 
-            if callback is not None:
-                out.append(callback(resp))
-            else:
-                out.append(resp)
-        return out
+            resps = self._produce_coalescer.send(send, payloads, acks,
+                                                 timeout)
+        else:
+            resps = self._send_broker_aware_request(payloads, encoder, decoder)
+        return self._handle_responses(resps, fail_on_error, callback)
 
     def send_fetch_request(self, payloads=[], fail_on_error=True,
-                           callback=None, max_wait_time=100, min_bytes=4096):
+                           callback=None, max_wait_time=100, min_bytes=4096,
+                           views=False, check_crcs=True, columnar=False):
         """
         Encode and send a FetchRequest
 
         Payloads are grouped by topic and partition so they can be pipelined
         to the same brokers.
+
+        If views is set, the keys and values of the messages are read-only
+        views into the response rather than copies. If check_crcs is not
+        set, message checksums are not verified. If columnar is set, the
+        messages of each FetchResponse are a MessageBatch. See
+        KafkaProtocol.decode_fetch_response.
         """
 
         encoder = partial(KafkaProtocol.encode_fetch_request,
                           max_wait_time=max_wait_time,
                           min_bytes=min_bytes)
+        decoder = partial(KafkaProtocol.decode_fetch_response,
+                          views=views, check_crcs=check_crcs,
+                          columnar=columnar)
 
-        resps = self._send_broker_aware_request(
-            payloads, encoder,
-            KafkaProtocol.decode_fetch_response)
+        resps = self._send_broker_aware_request(payloads, encoder, decoder)
+        return self._handle_responses(resps, fail_on_error, callback)
+
+    def iter_fetch_responses(self, payloads=[], fail_on_error=True,
+                             callback=None, max_wait_time=100, min_bytes=4096,
+                             views=False, check_crcs=True, columnar=False):
+        """
+        Encode and send a FetchRequest, yielding each FetchResponse as soon
+        as the response of its broker has been read
+
+        Unlike send_fetch_request, the responses of the brokers that answer
+        first can be processed while the others are still being waited for.
+        The order is that in which the brokers answer, not that of the
+        payloads. Errors are raised when reached while iterating.
+        """
+
+        encoder = partial(KafkaProtocol.encode_fetch_request,
+                          max_wait_time=max_wait_time,
+                          min_bytes=min_bytes)
+        decoder = partial(KafkaProtocol.decode_fetch_response,
+                          views=views, check_crcs=check_crcs,
+                          columnar=columnar)
+
+        resps = self._iter_broker_aware_request(payloads, encoder, decoder)
 
-        out = []
         for resp in resps:
             if fail_on_error is True:
                 self._raise_on_response_error(resp)
 
             if callback is not None:
-                out.append(callback(resp))
+                yield callback(resp)
             else:
-                out.append(resp)
-        return out
+                yield resp
 
     def send_offset_request(self, payloads=[], fail_on_error=True,
                             callback=None):
@@ -346,16 +1089,7 @@ class KafkaClient(object):
             payloads,
             KafkaProtocol.encode_offset_request,
             KafkaProtocol.decode_offset_response)
-
-        out = []
-        for resp in resps:
-            if fail_on_error is True:
-                self._raise_on_response_error(resp)
-            if callback is not None:
-                out.append(callback(resp))
-            else:
-                out.append(resp)
-        return out
+        return self._handle_responses(resps, fail_on_error, callback)
 
     def send_offset_commit_request(self, group, payloads=[],
                                    fail_on_error=True, callback=None):
@@ -363,17 +1097,7 @@ class KafkaClient(object):
                           group=group)
         decoder = KafkaProtocol.decode_offset_commit_response
         resps = self._send_broker_aware_request(payloads, encoder, decoder)
-
-        out = []
-        for resp in resps:
-            if fail_on_error is True:
-                self._raise_on_response_error(resp)
-
-            if callback is not None:
-                out.append(callback(resp))
-            else:
-                out.append(resp)
-        return out
+        return self._handle_responses(resps, fail_on_error, callback)
 
     def send_offset_fetch_request(self, group, payloads=[],
                                   fail_on_error=True, callback=None):
@@ -382,13 +1106,4 @@ class KafkaClient(object):
                           group=group)
         decoder = KafkaProtocol.decode_offset_fetch_response
         resps = self._send_broker_aware_request(payloads, encoder, decoder)
-
-        out = []
-        for resp in resps:
-            if fail_on_error is True:
-                self._raise_on_response_error(resp)
-            if callback is not None:
-                out.append(callback(resp))
-            else:
-                out.append(resp)
-        return out
+        return self._handle_responses(resps, fail_on_error, callback)
@@ -30,6 +30,9 @@ if is_py3:
     def str(x):
         return codecs.unicode_escape_decode(x)[0]
 
+    def view(data, start, size):
+        return memoryview(data)[start:start + size]
+
 else:
     from cStringIO import StringIO
     from Queue import Empty, Queue
@@ -54,3 +57,8 @@ else:
     def str(x):
         return x
 
+    def view(data, start, size):
+        # Slicing a buffer copies it, and memoryviews are not accepted by
+        # struct or zlib on Python 2
+        return buffer(data, start, size)
+
@@ -1,17 +1,42 @@
 import copy
 import logging
+import os
 import socket
 import struct
-from random import shuffle
-from threading import local
+import time
+from contextlib import contextmanager
+from random import shuffle, uniform
+from threading import Condition, Lock
 
 from kafka.common import ConnectionError
+from kafka.metrics import ConnectionMetrics
 from kafka import compat
 
 log = logging.getLogger("kafka")
 
 DEFAULT_SOCKET_TIMEOUT_SECONDS = 120
+DEFAULT_CONNECT_TIMEOUT_SECONDS = 5
+DEFAULT_RECONNECT_BACKOFF_SECONDS = 0.05
+DEFAULT_MAX_RECONNECT_BACKOFF_SECONDS = 5
 DEFAULT_KAFKA_PORT = 9092
+DEFAULT_POOL_SIZE = 8
+DEFAULT_POOL_MAX_IDLE_SECONDS = 300
+
+# Options applied to every broker socket unless told otherwise: small
+# requests (e.g. acks=1 produces) are not held back by Nagle's algorithm
+DEFAULT_SOCKET_OPTIONS = [
+    (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+]
+
+_SIZE_HEADER = struct.Struct('>i')
+
+# Stay below IOV_MAX, the most buffers a single sendmsg call may write
+_MAX_IOVECS = 1024
+
+try:
+    memoryview
+except NameError:  # Python 2.6
+    memoryview = None
 
 
 def collect_hosts(hosts, randomize=True):
@@ -37,28 +62,55 @@ def collect_hosts(hosts, randomize=True):
     return result
 
 
-class KafkaConnection(local):
+class KafkaConnection(object):
     """
     A socket connection to a single Kafka broker
 
-    This class is _not_ thread safe. Each call to `send` must be followed
-    by a call to `recv` in order to get the correct response. Eventually,
-    we can do something in here to facilitate multiplexed requests/responses
-    since the Kafka API includes a correlation id.
+    Requests are multiplexed over the socket using their correlation id:
+    any number of requests may be sent before their responses are read,
+    and `recv` returns the response matching the given request id,
+    buffering responses to other requests until they are asked for.
+
+    The connection is opened lazily, by the first `send` or `recv`, and
+    reopened the same way after it fails or is closed, or when used in a
+    process forked after it was opened.
 
     host:    the host name or IP address of a kafka broker
     port:    the port number the kafka broker is listening on
     timeout: default 120. The socket timeout for sending and receiving data
              in seconds. None means no timeout, so a request can block forever.
+    connect_timeout: default 5. Seconds to wait for the broker to accept
+             the connection, so a dead host is given up on quickly.
+    socket_options: list of (level, option, value) tuples passed to
+             setsockopt on every (re)connect, before connecting so that
+             buffer sizes also shape the TCP window. Defaults to
+             DEFAULT_SOCKET_OPTIONS (TCP_NODELAY). For example, for large
+             fetches over a long fat link:
+                 DEFAULT_SOCKET_OPTIONS + [
+                     (socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024),
+                     (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    metrics: a kafka.metrics.ConnectionMetrics to record I/O counters and
+             latencies in, or None (the default) to record nothing.
     """
-    def __init__(self, host, port, timeout=DEFAULT_SOCKET_TIMEOUT_SECONDS):
-        super(KafkaConnection, self).__init__()
+    def __init__(self, host, port, timeout=DEFAULT_SOCKET_TIMEOUT_SECONDS,
+                 socket_options=None,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT_SECONDS,
+                 metrics=None):
         self.host = host
         self.port = port
         self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        if socket_options is None:
+            socket_options = DEFAULT_SOCKET_OPTIONS
+        self.socket_options = list(socket_options)
+        self.metrics = metrics
         self._sock = None
-
-        self.reinit()
+        self._header = bytearray(_SIZE_HEADER.size)
+        self._send_lock = Lock()
+        self._recv_lock = Lock()
+        self._responses = {}  # correlation_id -> response body
+        self._dirty = True    # not connected yet
+        self._pid = None      # process the socket was opened in
 
     def __repr__(self):
         return "<KafkaConnection host=%s port=%d>" % (self.host, self.port)
@@ -69,77 +121,212 @@ class KafkaConnection(local):
 
     def _raise_connection_error(self):
         self._dirty = True
+        if self.metrics is not None:
+            self.metrics.incr('errors')
         raise ConnectionError("Kafka @ {0}:{1} went away".format(self.host, self.port))
 
-    def _read_bytes(self, num_bytes):
-        bytes_left = num_bytes
-        response = bytearray()
+    def _create_socket(self):
+        """
+        Open a socket to the broker with the socket options applied
+
+        Works like socket.create_connection, which gives no chance to set
+        options before connecting.
+        """
+        error = None
+        for (family, socktype, proto, _, address) in socket.getaddrinfo(
+                self.host, self.port, 0, socket.SOCK_STREAM):
+            sock = None
+            try:
+                sock = socket.socket(family, socktype, proto)
+                for option in self.socket_options:
+                    sock.setsockopt(*option)
+                sock.settimeout(self.connect_timeout)
+                sock.connect(address)
+                sock.settimeout(self.timeout)
+                return sock
+            except socket.error as e:
+                error = e
+                if sock is not None:
+                    sock.close()
+
+        if error is None:
+            error = socket.error("getaddrinfo returned no address for %s:%d" %
+                                 (self.host, self.port))
+        raise error
+
+    def _read_into(self, buf):
+        """
+        Fill `buf` from the socket, reading straight into it with recv_into
+        """
+        num_bytes = len(buf)
+        bytes_read = 0
+        calls = 0
+        view = memoryview(buf) if memoryview is not None else None
 
         log.debug("About to read %d bytes from Kafka", num_bytes)
-        if self._dirty:
+        if self._dirty or self._pid != os.getpid():
             self.reinit()
 
-        while bytes_left:
+        while bytes_read < num_bytes:
             try:
-                data = self._sock.recv(min(bytes_left, 4096))
+                if view is not None:
+                    read = self._sock.recv_into(view[bytes_read:],
+                                                num_bytes - bytes_read)
+                else:
+                    data = self._sock.recv(num_bytes - bytes_read)
+                    read = len(data)
+                    buf[bytes_read:bytes_read + read] = data
             except socket.error:
                 log.exception('Unable to receive data from Kafka')
                 self._raise_connection_error()
 
-            if data == '':
+            calls += 1
+            if not read:
                 log.error("Not enough data to read this response")
                 self._raise_connection_error()
 
-            bytes_left -= len(data)
-            log.debug("Read %d/%d bytes from Kafka", num_bytes - bytes_left, num_bytes)
-            response.extend(data)
+            bytes_read += read
+            log.debug("Read %d/%d bytes from Kafka", bytes_read, num_bytes)
 
-        return bytes(response)
+        if self.metrics is not None:
+            self.metrics.incr('recv_calls', calls)
+            self.metrics.incr('bytes_received', num_bytes)
+        return buf
+
+    def _send_segments(self, segments):
+        """
+        Write every buffer in `segments` to the socket, in order
+        """
+        if len(segments) == 1 or not hasattr(self._sock, 'sendmsg'):
+            if len(segments) == 1:
+                data = segments[0]
+            else:
+                data = b"".join(segments)
+            sent = self._sock.sendall(data)
+            if sent is not None:
+                self._raise_connection_error()
+            if self.metrics is not None:
+                self.metrics.incr('send_calls')
+            return
+
+        segments = list(segments)
+        start = 0
+        while start < len(segments):
+            sent = self._sock.sendmsg(segments[start:start + _MAX_IOVECS])
+            if self.metrics is not None:
+                self.metrics.incr('send_calls')
+
+            # Skip whatever was written, resuming a partially written
+            # buffer from a view of its remainder
+            while start < len(segments) and sent >= len(segments[start]):
+                sent -= len(segments[start])
+                start += 1
+            if sent:
+                segments[start] = memoryview(segments[start])[sent:]
+
+    def _read_response(self):
+        """
+        Read the next response off the socket, whatever its correlation id
+
+        The body is read into a single buffer allocated at its final size
+        and returned as a read-only view of it, so it is never copied.
+        """
+        metrics = self.metrics
+        if metrics is None:
+            (size,) = _SIZE_HEADER.unpack(self._read_into(self._header))
+            return compat.buffer(self._read_into(bytearray(size)))
+
+        # Same as above, timing the wait for the response to start coming
+        # in apart from the time taken to read the rest of it
+        start = time.time()
+        (size,) = _SIZE_HEADER.unpack(self._read_into(self._header))
+        header_read = time.time()
+        body = self._read_into(bytearray(size))
+        metrics.observe('first_byte_time', header_read - start)
+        metrics.observe('body_read_time', time.time() - header_read)
+        metrics.incr('responses')
+        return compat.buffer(body)
 
     ##################
     #   Public API   #
     ##################
 
-    # TODO multiplex socket communication to allow for multi-threaded clients
-
     def send(self, request_id, payload):
-        "Send a request to Kafka"
-        log.debug("About to send %d bytes to Kafka, request %d" % (len(payload), request_id))
-        try:
-            if self._dirty:
-                self.reinit()
-            sent = self._sock.sendall(payload)
-            if sent is not None:
+        """
+        Send a request to Kafka
+
+        payload is either the encoded request or a list of buffers that
+        make it up. A list is written with vectored I/O where the platform
+        supports it, so the buffers are never joined into one string.
+        """
+        if isinstance(payload, (list, tuple)):
+            segments = payload
+        else:
+            segments = [payload]
+
+        log.debug("About to send %d bytes to Kafka, request %d" %
+                  (sum(len(s) for s in segments), request_id))
+        with self._send_lock:
+            try:
+                if self._dirty or self._pid != os.getpid():
+                    self.reinit()
+                if self.metrics is None:
+                    self._send_segments(segments)
+                else:
+                    start = time.time()
+                    self._send_segments(segments)
+                    self.metrics.observe('send_time', time.time() - start)
+                    self.metrics.incr('requests')
+                    self.metrics.incr('bytes_sent',
+                                      sum(len(s) for s in segments))
+            except socket.error:
+                log.exception('Unable to send payload to Kafka')
                 self._raise_connection_error()
-        except socket.error:
-            log.exception('Unable to send payload to Kafka')
-            self._raise_connection_error()
 
     def recv(self, request_id):
         """
-        Get a response from Kafka
+        Get the response to request `request_id` from Kafka
+
+        Responses to other requests read while waiting are kept until
+        `recv` is called for them, so responses may be collected in any
+        order once their requests have been sent.
         """
         log.debug("Reading response %d from Kafka" % request_id)
-        # Read the size off of the header
-        resp = self._read_bytes(4)
+        with self._recv_lock:
+            while request_id not in self._responses:
+                resp = self._read_response()
+                (correlation_id,) = struct.unpack_from('>i', resp)
+                if correlation_id != request_id:
+                    log.debug("Buffering response %d from Kafka", correlation_id)
+                self._responses[correlation_id] = resp
+
+            return self._responses.pop(request_id)
 
-        (size,) = struct.unpack('>i', resp)
+    def has_response(self, request_id):
+        """
+        Whether the response to `request_id` has already been read and is
+        waiting to be collected with `recv`
+        """
+        return request_id in self._responses
 
-        # Read the remainder of the response
-        resp = self._read_bytes(size)
-        return resp
+    def fileno(self):
+        """
+        The file descriptor of the socket, so connections can be watched
+        with select/selectors
+        """
+        return self._sock.fileno()
 
     def copy(self):
         """
-        Create an inactive copy of the connection object
-        A reinit() has to be done on the copy before it can be used again
+        Create an unconnected copy of the connection object, which connects
+        on first use
         """
-        c = copy.deepcopy(self)
-        c._sock = None
-        return c
+        return copy.deepcopy(self)
 
     def __deepcopy__(self, memo):
-        return KafkaConnection(self.host, self.port, self.timeout)
+        return KafkaConnection(self.host, self.port, self.timeout,
+                               self.socket_options, self.connect_timeout,
+                               self.metrics)
 
     def close(self):
         """
@@ -147,11 +334,264 @@ class KafkaConnection(local):
         """
         if self._sock:
             self._sock.close()
+            self._sock = None
+        self._dirty = True
 
     def reinit(self):
         """
         Re-initialize the socket connection
         """
         self.close()
-        self._sock = socket.create_connection((self.host, self.port), self.timeout)
+        # Responses buffered from the old socket can never be matched now
+        self._responses.clear()
+        start = time.time()
+        try:
+            self._sock = self._create_socket()
+        except socket.error as e:
+            log.warning("Unable to connect to Kafka @ %s:%d: %s",
+                        self.host, self.port, e)
+            if self.metrics is not None:
+                self.metrics.incr('errors')
+            raise ConnectionError("Kafka @ {0}:{1} unreachable: {2}".format(
+                self.host, self.port, e))
         self._dirty = False
+        self._pid = os.getpid()
+        if self.metrics is not None:
+            self.metrics.observe('connect_time', time.time() - start)
+            self.metrics.incr('connects')
+
+
+class KafkaConnectionPool(object):
+    """
+    A bounded pool of connections to a single Kafka broker, which also
+    tracks whether the broker is reachable
+
+    A connection is checked out for the exclusive use of one thread and
+    checked back in when that thread is done with it, so any number of
+    threads can share a pool. At most `size` connections are open at once;
+    once they are all checked out, `checkout` waits for one to be checked
+    back in. The most recently used connection is handed out first, and
+    connections left idle for longer than `max_idle` seconds are closed.
+
+    When a connection fails the broker is put in reconnect backoff: for
+    `reconnect_backoff` seconds, doubling with each consecutive failure up
+    to `max_reconnect_backoff`, `checkout` fails straight away instead of
+    trying the broker again. A successful request resets the backoff.
+
+    host:     the host name or IP address of a kafka broker
+    port:     the port number the kafka broker is listening on
+    timeout:  default 120. The socket timeout of the connections, which is
+              also how long `checkout` waits for a free connection
+    size:     default 8. The maximum number of open connections
+    max_idle: default 300. Seconds after which an unused connection is
+              closed. None means connections are kept open forever.
+    socket_options, connect_timeout, metrics: passed on to each
+              KafkaConnection, so `metrics` adds up the I/O of all of them
+    reconnect_backoff: default 0.05. Seconds to stay away from the broker
+              after a first failure
+    max_reconnect_backoff: default 5. Upper bound of the backoff
+    """
+    def __init__(self, host, port, timeout=DEFAULT_SOCKET_TIMEOUT_SECONDS,
+                 size=DEFAULT_POOL_SIZE,
+                 max_idle=DEFAULT_POOL_MAX_IDLE_SECONDS,
+                 socket_options=None,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT_SECONDS,
+                 reconnect_backoff=DEFAULT_RECONNECT_BACKOFF_SECONDS,
+                 max_reconnect_backoff=DEFAULT_MAX_RECONNECT_BACKOFF_SECONDS,
+                 metrics=None):
+        if size < 1:
+            raise ValueError('Pool size must be at least 1')
+
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.size = size
+        self.max_idle = max_idle
+        self.socket_options = socket_options
+        self.connect_timeout = connect_timeout
+        self.reconnect_backoff = reconnect_backoff
+        self.max_reconnect_backoff = max_reconnect_backoff
+        self.metrics = metrics
+
+        self._cond = Condition(Lock())
+        self._idle = []    # [(connection, last checkin time)], oldest first
+        self._open = 0     # connections created and not closed since
+        self._failures = 0     # consecutive failed requests or connects
+        self._retry_at = 0     # time.time() when the backoff ends
+        self._pid = os.getpid()
+
+    def __repr__(self):
+        return "<KafkaConnectionPool host=%s port=%d size=%d>" % (
+            self.host, self.port, self.size)
+
+    ###################
+    #   Private API   #
+    ###################
+
+    def _check_fork(self):
+        """
+        Start afresh if running in a process forked from the one the pool
+        was used in: its connections belong to the parent, and its lock
+        may have been held by a thread that did not survive the fork.
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._cond = Condition(Lock())
+            self._idle = []
+            self._open = 0
+
+    def _evict_idle(self):
+        """
+        Close connections idle for longer than max_idle. Must be called
+        with the pool lock held.
+        """
+        if self.max_idle is None:
+            return
+
+        expired = time.time() - self.max_idle
+        while self._idle and self._idle[0][1] < expired:
+            conn, _ = self._idle.pop(0)
+            log.debug("Closing idle connection %s", conn)
+            conn.close()
+            self._open -= 1
+
+    def _new_connection(self):
+        return KafkaConnection(self.host, self.port, timeout=self.timeout,
+                               socket_options=self.socket_options,
+                               connect_timeout=self.connect_timeout,
+                               metrics=self.metrics)
+
+    def _record_failure(self):
+        """
+        Put the broker in (longer) reconnect backoff. Must be called with
+        the pool lock held.
+        """
+        self._failures += 1
+        backoff = min(self.reconnect_backoff * 2 ** (self._failures - 1),
+                      self.max_reconnect_backoff)
+        # Jitter keeps clients that failed together from retrying together
+        backoff *= uniform(0.8, 1.2)
+        self._retry_at = time.time() + backoff
+        log.debug("Backing off %s for %.3fs after %d failure(s)",
+                  self, backoff, self._failures)
+
+    ##################
+    #   Public API   #
+    ##################
+
+    def checkout(self):
+        """
+        Take a connection out of the pool, opening a new one if none is
+        idle and the pool is not full
+
+        Raises ConnectionError if the broker is in reconnect backoff, or
+        if no connection is checked back in within the pool timeout.
+        """
+        self._check_fork()
+        with self._cond:
+            if self.in_backoff():
+                raise ConnectionError(
+                    "Kafka @ {0}:{1} failed recently, backing off".format(
+                        self.host, self.port))
+
+            self._evict_idle()
+
+            if self.timeout is not None:
+                deadline = time.time() + self.timeout
+
+            while not self._idle and self._open >= self.size:
+                if self.timeout is None:
+                    self._cond.wait()
+                    continue
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise ConnectionError(
+                        "No connection to Kafka @ {0}:{1} available".format(
+                            self.host, self.port))
+                self._cond.wait(remaining)
+
+            if self._idle:
+                conn, _ = self._idle.pop()
+                return conn
+
+            self._open += 1
+
+        # Connections only connect when first used, so a broker that can't
+        # be reached is reported through checkin(failed=True)
+        return self._new_connection()
+
+    def checkin(self, conn, failed=False):
+        """
+        Return a connection obtained from `checkout` to the pool
+
+        failed tells whether the request made with the connection failed
+        to reach the broker, which puts the broker in reconnect backoff.
+        """
+        self._check_fork()
+        with self._cond:
+            if failed:
+                self._record_failure()
+            else:
+                self._failures = 0
+                self._retry_at = 0
+            self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    def in_backoff(self):
+        """
+        Whether the broker failed recently and should not be contacted yet
+        """
+        return self._retry_at > time.time()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager checking out a connection for the with block
+        """
+        conn = self.checkout()
+        try:
+            yield conn
+        except ConnectionError:
+            self.checkin(conn, failed=True)
+            raise
+        except Exception:
+            self.checkin(conn)
+            raise
+        else:
+            self.checkin(conn)
+
+    def close(self):
+        """
+        Close the idle connections. Connections currently checked out are
+        left alone and can still be checked in.
+        """
+        with self._cond:
+            for conn, _ in self._idle:
+                conn.close()
+            self._open -= len(self._idle)
+            self._idle = []
+            self._cond.notify_all()
+
+    def reinit(self):
+        """
+        Drop the idle connections, so fresh ones are opened as needed
+        """
+        self.close()
+
+    def copy(self):
+        """
+        Create an empty pool to the same broker with the same settings,
+        collecting metrics of its own if this one does
+        """
+        metrics = None
+        if self.metrics is not None:
+            metrics = ConnectionMetrics()
+        return KafkaConnectionPool(self.host, self.port, self.timeout,
+                                   self.size, self.max_idle,
+                                   self.socket_options, self.connect_timeout,
+                                   self.reconnect_backoff,
+                                   self.max_reconnect_backoff, metrics)
+
+    def __deepcopy__(self, memo):
+        return self.copy()
@@ -33,6 +33,19 @@ ITER_TIMEOUT_SECONDS = 60
 NO_MESSAGES_WAIT_TIME_SECONDS = 0.1
 
 
+def _grown_buffer_size(buffer_size, max_buffer_size):
+    """
+    The buffer size to fetch with again after a message did not fit in
+    buffer_size bytes: twice as large, but no more than max_buffer_size.
+    None if the buffer already is max_buffer_size bytes.
+    """
+    if max_buffer_size is None:
+        return buffer_size * 2
+    if buffer_size == max_buffer_size:
+        return None
+    return min(buffer_size * 2, max_buffer_size)
+
+
 class FetchContext(object):
     """
     Class for managing the state of a consumer during fetch
@@ -108,11 +121,13 @@ class Consumer(object):
                 return 0
 
         if auto_commit:
-            for partition in partitions:
-                req = OffsetFetchRequest(topic, partition)
-                (offset,) = self.client.send_offset_fetch_request(group, [req],
-                              callback=get_or_init_offset_callback,
-                              fail_on_error=False)
+            # One request for the offsets of all the partitions
+            reqs = [OffsetFetchRequest(topic, partition)
+                    for partition in partitions]
+            offsets = self.client.send_offset_fetch_request(group, reqs,
+                          callback=get_or_init_offset_callback,
+                          fail_on_error=False)
+            for partition, offset in zip(partitions, offsets):
                 self.offsets[partition] = offset
         else:
             for partition in partitions:
@@ -221,6 +236,15 @@ class SimpleConsumer(Consumer):
     iter_timeout:        default None. How much time (in seconds) to wait for a
                          message in the iterator before exiting. None means no
                          timeout, so it will wait forever.
+    fetch_scheduler:     default None. A FetchScheduler to fetch through, so
+                         messages are fetched for all of its consumers at once
+    message_views:       default False. Whether message keys and values are
+                         read-only views into the fetch response rather than
+                         bytes. Saves copying them, but a message kept around
+                         keeps its whole response in memory.
+    check_crcs:          default True. Whether to verify the checksum of every
+                         message. Skipping it saves CPU on large messages,
+                         but corrupted messages are then handed out as is.
 
     Auto commit details:
     If both auto_commit_every_n and auto_commit_every_t are set, they will
@@ -234,7 +258,8 @@ class SimpleConsumer(Consumer):
                  fetch_size_bytes=FETCH_MIN_BYTES,
                  buffer_size=FETCH_BUFFER_SIZE_BYTES,
                  max_buffer_size=MAX_FETCH_BUFFER_SIZE_BYTES,
-                 iter_timeout=None):
+                 iter_timeout=None, fetch_scheduler=None,
+                 message_views=False, check_crcs=True):
         super(SimpleConsumer, self).__init__(
             client, group, topic,
             partitions=partitions,
@@ -253,7 +278,12 @@ class SimpleConsumer(Consumer):
         self.fetch_min_bytes = fetch_size_bytes
         self.fetch_offsets = self.offsets.copy()
         self.iter_timeout = iter_timeout
+        self.message_views = message_views
+        self.check_crcs = check_crcs
         self.queue = Queue()
+        self.fetch_scheduler = None
+        if fetch_scheduler is not None:
+            fetch_scheduler.register(self)
 
     def __repr__(self):
         return '<SimpleConsumer group=%s, topic=%s, partitions=%s>' % \
@@ -408,48 +438,146 @@ class SimpleConsumer(Consumer):
                 break
 
     def _fetch(self):
-        # Create fetch request payloads for all the partitions
-        requests = []
-        partitions = self.fetch_offsets.keys()
+        if self.fetch_scheduler is not None:
+            self.fetch_scheduler.fetch(
+                max_wait_time=self.fetch_max_wait_time,
+                min_bytes=self.fetch_min_bytes)
+            return
+
+        partitions = list(self.fetch_offsets.keys())
         while partitions:
-            for partition in partitions:
-                requests.append(FetchRequest(self.topic, partition,
-                                             self.fetch_offsets[partition],
-                                             self.buffer_size))
-            # Send request
-            responses = self.client.send_fetch_request(
+            # Create fetch request payloads for all the partitions
+            requests = [self._fetch_request(partition)
+                        for partition in partitions]
+            # Send request, handling each broker's response as it arrives
+            responses = self.client.iter_fetch_responses(
                 requests,
                 max_wait_time=int(self.fetch_max_wait_time),
-                min_bytes=self.fetch_min_bytes)
+                min_bytes=self.fetch_min_bytes,
+                views=self.message_views,
+                check_crcs=self.check_crcs)
+
+            partitions = [resp.partition for resp in responses
+                          if self._handle_fetch_response(resp)]
+
+    def _fetch_request(self, partition):
+        return FetchRequest(self.topic, partition,
+                            self.fetch_offsets[partition], self.buffer_size)
 
-            retry_partitions = set()
-            for resp in responses:
-                partition = resp.partition
-                try:
-                    for message in resp.messages:
-                        # Put the message in our queue
-                        self.queue.put((partition, message))
-                        self.fetch_offsets[partition] = message.offset + 1
-                except ConsumerFetchSizeTooSmall:
-                    if (self.max_buffer_size is not None and
-                            self.buffer_size == self.max_buffer_size):
-                        log.error("Max fetch size %d too small",
-                                  self.max_buffer_size)
-                        raise
-                    if self.max_buffer_size is None:
-                        self.buffer_size *= 2
-                    else:
-                        self.buffer_size = max(self.buffer_size * 2,
-                                               self.max_buffer_size)
-                    log.warn("Fetch size too small, increase to %d (2x) "
-                             "and retry", self.buffer_size)
-                    retry_partitions.add(partition)
-                except ConsumerNoMoreData as e:
-                    log.debug("Iteration was ended by %r", e)
-                except StopIteration:
-                    # Stop iterating through this partition
-                    log.debug("Done iterating over partition %s" % partition)
-                partitions = retry_partitions
+    def _handle_fetch_response(self, resp):
+        """
+        Queue the messages of a FetchResponse. Returns True if the buffer
+        size was too small for them, and has been grown so the partition
+        can be fetched again.
+        """
+        partition = resp.partition
+        try:
+            for message in resp.messages:
+                # Put the message in our queue
+                self.queue.put((partition, message))
+                self.fetch_offsets[partition] = message.offset + 1
+        except ConsumerFetchSizeTooSmall:
+            buffer_size = _grown_buffer_size(self.buffer_size,
+                                             self.max_buffer_size)
+            if buffer_size is None:
+                log.error("Max fetch size %d too small",
+                          self.max_buffer_size)
+                raise
+            self.buffer_size = buffer_size
+            log.warn("Fetch size too small, increase to %d (2x) "
+                     "and retry", self.buffer_size)
+            return True
+        except ConsumerNoMoreData as e:
+            log.debug("Iteration was ended by %r", e)
+        except StopIteration:
+            # Stop iterating through this partition
+            log.debug("Done iterating over partition %s" % partition)
+        return False
+
+
+class FetchScheduler(object):
+    """
+    Fetches messages for many SimpleConsumers, of any topics, at once
+
+    Rather than each consumer sending its own FetchRequests, whenever one
+    of the registered consumers runs out of messages a single fetch is
+    made for every registered consumer that has none left, so there is one
+    request per broker for all of them.
+
+    client: the KafkaClient the consumers use
+
+    Usage:
+    scheduler = FetchScheduler(kafka)
+    consumers = [SimpleConsumer(kafka, "my-group", topic,
+                                fetch_scheduler=scheduler)
+                 for topic in topics]
+    """
+    def __init__(self, client):
+        self.client = client
+        self.consumers = []
+        self._lock = Lock()
+
+    def __repr__(self):
+        return '<FetchScheduler consumers=%d>' % len(self.consumers)
+
+    def register(self, consumer):
+        """
+        Have `consumer` fetch its messages through this scheduler
+        """
+        with self._lock:
+            self.consumers.append(consumer)
+        consumer.fetch_scheduler = self
+
+    def unregister(self, consumer):
+        with self._lock:
+            self.consumers.remove(consumer)
+        consumer.fetch_scheduler = None
+
+    def fetch(self, max_wait_time=FETCH_MAX_WAIT_TIME,
+              min_bytes=FETCH_MIN_BYTES):
+        """
+        Fetch the partitions of every registered consumer whose queue is
+        empty, with a single request per broker
+
+        A partition consumed by more than one consumer is fetched for each
+        of them in turn, as a request can only fetch a partition once.
+        Messages are only decoded as views, or without verifying their
+        checksums, when every consumer in a request asked for it.
+        """
+        with self._lock:
+            pending = [(consumer, partition)
+                       for consumer in self.consumers
+                       if consumer.queue.empty()
+                       for partition in consumer.fetch_offsets]
+
+            while pending:
+                owners = {}   # (topic, partition) -> consumer
+                requests = []
+                deferred = []
+                for consumer, partition in pending:
+                    key = (consumer.topic, partition)
+                    if key in owners:
+                        deferred.append((consumer, partition))
+                        continue
+                    owners[key] = consumer
+                    requests.append(consumer._fetch_request(partition))
+
+                responses = self.client.iter_fetch_responses(
+                    requests,
+                    max_wait_time=int(max_wait_time),
+                    min_bytes=min_bytes,
+                    views=all(consumer.message_views
+                              for consumer in owners.values()),
+                    check_crcs=any(consumer.check_crcs
+                                   for consumer in owners.values()))
+
+                retries = []
+                for resp in responses:
+                    consumer = owners[(resp.topic, resp.partition)]
+                    if consumer._handle_fetch_response(resp):
+                        retries.append((consumer, resp.partition))
+
+                pending = retries + deferred
 
 def _mp_consume(client, group, topic, chunk, queue, start, exit, pause, size):
     """
@@ -0,0 +1,114 @@
+import bisect
+from threading import Lock
+
+
+class Histogram(object):
+    """
+    A latency histogram with fixed, roughly exponential buckets
+
+    Values are in seconds. Recording a value is a bisect and a few
+    additions, so it is cheap enough to do for every request.
+    """
+    BUCKETS = (
+        0.0001, 0.00025, 0.0005,
+        0.001, 0.0025, 0.005,
+        0.01, 0.025, 0.05,
+        0.1, 0.25, 0.5,
+        1.0, 2.5, 5.0,
+        10.0, 30.0, 60.0,
+    )
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)  # last one is overflow
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, pct):
+        """
+        Upper bound of the bucket holding the pct-th percentile, or None if
+        nothing was recorded. Values past the last bucket report the max.
+        """
+        if not self.count:
+            return None
+
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'buckets': list(zip(self.BUCKETS + (float('inf'),), self.counts)),
+        }
+
+
+class ConnectionMetrics(object):
+    """
+    I/O counters and latency histograms for the connections to one broker
+
+    Counters:
+    bytes_sent, bytes_received: bytes written to and read from sockets
+    requests, responses:        requests sent and responses read
+    send_calls:                 socket send operations, each a sendall or
+                                sendmsg call however many writes it takes
+    recv_calls:                 socket recv system calls made
+    connects, errors:           (re)connects and connection errors
+
+    Histograms (seconds):
+    connect_time:    time to open a connection
+    send_time:       time blocked writing a request
+    first_byte_time: time blocked waiting for the size header of a response
+    body_read_time:  time spent reading the rest of a response
+
+    A single instance is shared by every connection to a broker, so all
+    updates take a lock.
+    """
+    COUNTERS = ('bytes_sent', 'bytes_received', 'requests', 'responses',
+                'send_calls', 'recv_calls', 'connects', 'errors')
+    HISTOGRAMS = ('connect_time', 'send_time', 'first_byte_time',
+                  'body_read_time')
+
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = dict((name, 0) for name in self.COUNTERS)
+            self.histograms = dict((name, Histogram())
+                                   for name in self.HISTOGRAMS)
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            self.histograms[name].record(seconds)
+
+    def snapshot(self):
+        """
+        Return a copy of the counters and histogram summaries as a dict
+        """
+        with self._lock:
+            out = dict(self.counters)
+            for name, histogram in self.histograms.items():
+                out[name] = histogram.snapshot()
+        return out
@@ -1,9 +1,15 @@
 import logging
 import struct
 import zlib
-import sys
+from array import array
 from kafka import compat
 
+try:
+    import numpy
+    _has_numpy = True
+except ImportError:
+    _has_numpy = False
+
 from kafka.codec import (
     gzip_encode, gzip_decode, snappy_encode, snappy_decode
 )
@@ -15,8 +21,9 @@ from kafka.common import (
     UnsupportedCodecError
 )
 from kafka.util import (
-    read_short_string, read_int_string, relative_unpack,
-    write_short_string, write_int_string, group_by_topic_and_partition
+    read_short_string, read_int_string, relative_unpack, relative_unpack_from,
+    group_by_topic_and_partition,
+    INT16, INT32, INT64
 )
 
 log = logging.getLogger("kafka")
@@ -27,6 +34,34 @@ CODEC_GZIP = 0x01
 CODEC_SNAPPY = 0x02
 ALL_CODECS = (CODEC_NONE, CODEC_GZIP, CODEC_SNAPPY)
 
+# Precompiled structs for the fixed parts of requests and responses
+_REQUEST_HEADER = struct.Struct('>hhih')  # ApiKey ApiVersion CorrelationId
+                                          # and the length of ClientId
+_SIZED_REQUEST_HEADER = struct.Struct('>ihhih')  # Size, then as above
+_MESSAGE_SET_ITEM_CRC = struct.Struct('>qiI')  # Offset MessageSize Crc
+_MESSAGE_SET_ITEM = struct.Struct('>qi')  # Offset MessageSize
+_MESSAGE_HEADER = struct.Struct('>IBB')   # Crc MagicByte Attributes
+_MESSAGE_HEADER_KEY_SIZE = struct.Struct('>IBBi')  # and the size of Key
+_MAGIC_ATTRIBUTES_KEY_SIZE = struct.Struct('>BBi')
+_CRC = struct.Struct('>I')
+_ACKS_TIMEOUT_COUNT = struct.Struct('>hii')
+_INT32_INT32 = struct.Struct('>ii')
+_INT32_INT16 = struct.Struct('>ih')
+_INT32_INT64 = struct.Struct('>iq')
+_INT32_INT64_INT32 = struct.Struct('>iqi')
+_INT32_INT16_INT32 = struct.Struct('>ihi')
+_INT32_INT16_INT64 = struct.Struct('>ihq')
+_FETCH_REQUEST_HEADER = struct.Struct('>iiii')  # ReplicaId MaxWaitTime
+                                                # MinBytes and topic count
+_PARTITION_METADATA = struct.Struct('>hiii')
+
+# array('q') is Python 3 only, a long is 64 bit on most Python 2 platforms
+try:
+    array('q')
+    _INT64_TYPECODE = 'q'
+except ValueError:
+    _INT64_TYPECODE = 'l' if array('l').itemsize == 8 else None
+
 
 class KafkaProtocol(object):
     """
@@ -50,12 +85,11 @@ class KafkaProtocol(object):
         """
         Encode the common request envelope
         """
-        return struct.pack('>hhih%ds' % len(client_id),
-                           request_key,          # ApiKey
-                           0,                    # ApiVersion
-                           correlation_id,       # CorrelationId
-                           len(client_id),       # ClientId size
-                           compat.bytes(client_id))            # ClientId
+        return _REQUEST_HEADER.pack(request_key,      # ApiKey
+                                    0,                # ApiVersion
+                                    correlation_id,   # CorrelationId
+                                    len(client_id)    # ClientId size
+                                    ) + compat.bytes(client_id)  # ClientId
 
     @classmethod
     def _encode_message_set(cls, messages):
@@ -69,11 +103,9 @@ class KafkaProtocol(object):
           Offset => int64
           MessageSize => int32
         """
-        message_set = bytearray()
-        for message in messages:
-            encoded_message = KafkaProtocol._encode_message(message)
-            message_set.extend(struct.pack('>qi%ds' % len(encoded_message), 0, len(encoded_message), encoded_message))
-        return bytes(message_set)
+        buf = bytearray(cls._message_set_size(messages))
+        cls._write_message_set(buf, 0, messages)
+        return buf
 
     @classmethod
     def _encode_message(cls, message):
@@ -92,21 +124,99 @@ class KafkaProtocol(object):
           Key => bytes
           Value => bytes
         """
-        if message.magic == 0:
-            msg = struct.pack('>BB', message.magic, message.attributes)
-            msg += write_int_string(message.key)
-            msg += write_int_string(message.value)
-            crc = zlib.crc32(msg)
-            if sys.version > '3':
-                msg = struct.pack('>I%ds' % len(msg), crc, msg)
-            else:
-                msg = struct.pack('>i%ds' % len(msg), crc, msg)
-        else:
+        body = cls._encode_message_body(message)
+        return _CRC.pack(zlib.crc32(body) & 0xffffffff) + body
+
+    @classmethod
+    def _encode_message_body(cls, message):
+        """
+        Encode everything in a message after its checksum
+        """
+        if message.magic != 0:
             raise ProtocolError("Unexpected magic number: %d" % message.magic)
-        return msg
+
+        key, value = message.key, message.value
+        return b"".join([
+            _MAGIC_ATTRIBUTES_KEY_SIZE.pack(
+                message.magic, message.attributes,
+                len(key) if key is not None else -1),
+            key or b"",
+            INT32.pack(len(value) if value is not None else -1),
+            value or b"",
+        ])
+
+    # The request encoders work out the size of the whole request first,
+    # then write every field into a single bytearray allocated at that size,
+    # so encoding is linear in the size of the request. The _write_* methods
+    # write at cur in buf and return the offset just past what they wrote.
+
+    @classmethod
+    def _message_set_size(cls, messages):
+        # Offset, MessageSize, Crc, MagicByte, Attributes and the sizes of
+        # Key and Value
+        size = 0
+        for message in messages:
+            size += 26
+            if message.key is not None:
+                size += len(message.key)
+            if message.value is not None:
+                size += len(message.value)
+        return size
+
+    @classmethod
+    def _write_message_set(cls, buf, cur, messages):
+        encode_body = cls._encode_message_body
+        pack_into = _MESSAGE_SET_ITEM_CRC.pack_into
+        for message in messages:
+            body = encode_body(message)
+            start = cur + _MESSAGE_SET_ITEM_CRC.size
+            end = start + len(body)
+            # crc32 is signed on Python 2, the protocol wants it unsigned
+            pack_into(buf, cur, 0, _CRC.size + len(body),
+                      zlib.crc32(body) & 0xffffffff)
+            buf[start:end] = body
+            cur = end
+        return cur
+
+    @classmethod
+    def _short_string_size(cls, s):
+        return INT16.size + (len(s) if s is not None else 0)
+
+    @classmethod
+    def _write_short_string(cls, buf, cur, s):
+        if s is None:
+            INT16.pack_into(buf, cur, -1)
+            return cur + INT16.size
+
+        s = compat.bytes(s)
+        INT16.pack_into(buf, cur, len(s))
+        cur += INT16.size
+        buf[cur:cur + len(s)] = s
+        return cur + len(s)
 
     @classmethod
-    def _decode_message_set_iter(cls, data):
+    def _request_buffer(cls, client_id, correlation_id, request_key, size):
+        """
+        Allocate a request whose body after the common envelope is size bytes
+
+        Returns the buffer, with the request size and the envelope already
+        written, and the offset the body starts at. Encoders return the
+        filled buffer as is: sockets, struct and zlib take a bytearray as
+        they would bytes, so it is never copied.
+        """
+        header_size = _SIZED_REQUEST_HEADER.size + len(client_id)
+        buf = bytearray(header_size + size)
+        _SIZED_REQUEST_HEADER.pack_into(buf, 0,
+                                        len(buf) - INT32.size,  # Size
+                                        request_key,            # ApiKey
+                                        0,                      # ApiVersion
+                                        correlation_id,         # CorrelationId
+                                        len(client_id))         # ClientId size
+        buf[_SIZED_REQUEST_HEADER.size:header_size] = compat.bytes(client_id)
+        return buf, header_size
+
+    @classmethod
+    def _decode_message_set_iter(cls, data, views=False, check_crcs=True):
         """
         Iteratively decode a MessageSet
 
@@ -114,14 +224,18 @@ class KafkaProtocol(object):
         to decode a single message. Since compressed messages contain futher
         MessageSets, these two methods have been decoupled so that they may
         recurse easily.
+
+        Messages are decoded from views into data, so only their keys and
+        values are ever copied, and not even those if views is set.
         """
         cur = 0
         read_message = False
         while cur < len(data):
             try:
-                ((offset, ), cur) = relative_unpack('>q', data, cur)
-                (msg, cur) = read_int_string(data, cur)
-                for (offset, message) in KafkaProtocol._decode_message(msg, offset):
+                ((offset, ), cur) = relative_unpack_from(INT64, data, cur)
+                (msg, cur) = read_int_string(data, cur, view=True)
+                for (offset, message) in KafkaProtocol._decode_message(
+                        msg, offset, views, check_crcs):
                     read_message = True
                     yield OffsetAndMessage(offset, message)
             except BufferUnderflowError:
@@ -141,7 +255,7 @@ class KafkaProtocol(object):
                     raise StopIteration()
 
     @classmethod
-    def _decode_message(cls, data, offset):
+    def _decode_message(cls, data, offset, views=False, check_crcs=True):
         """
         Decode a single Message
 
@@ -149,32 +263,126 @@ class KafkaProtocol(object):
         They are decoupled to support nested messages (compressed MessageSets).
         The offset is actually read from decode_message_set_iter (it is part
         of the MessageSet payload).
-        """
-        if sys.version > '3':
-            ((crc, magic, att), cur) = relative_unpack('>IBB', data, 0)
-        else:
-            ((crc, magic, att), cur) = relative_unpack('>iBB', data, 0)
-        if crc != zlib.crc32(data[4:]):
-            raise ChecksumError("Message checksum failed")
 
-        (key, cur) = read_int_string(data, cur)
-        (value, cur) = read_int_string(data, cur)
+        If views is set, the key and value of an uncompressed message are
+        read-only views into data rather than bytes. If check_crcs is not
+        set, the checksum of the message is not verified.
+        """
+        ((crc, magic, att), cur) = relative_unpack_from(_MESSAGE_HEADER,
+                                                        data, 0)
+        if check_crcs:
+            # Checksum a view, slicing data would copy the whole message
+            crc_data = compat.view(data, 4, len(data) - 4)
+            if crc != zlib.crc32(crc_data) & 0xffffffff:
+                raise ChecksumError("Message checksum failed")
 
         codec = att & ATTRIBUTE_CODEC_MASK
 
+        # The value of a compressed message is only decompressed, so views
+        # would not save anything there
+        views = views and codec == CODEC_NONE
+        (key, cur) = read_int_string(data, cur, view=views)
+        (value, cur) = read_int_string(data, cur, view=views)
+
         if codec == CODEC_NONE:
             yield (offset, Message(magic, att, key, value))
 
         elif codec == CODEC_GZIP:
             gz = gzip_decode(value)
-            for (offset, msg) in KafkaProtocol._decode_message_set_iter(gz):
+            for (offset, msg) in KafkaProtocol._decode_message_set_iter(
+                    gz, views, check_crcs):
                 yield (offset, msg)
 
         elif codec == CODEC_SNAPPY:
             snp = snappy_decode(value)
-            for (offset, msg) in KafkaProtocol._decode_message_set_iter(snp):
+            for (offset, msg) in KafkaProtocol._decode_message_set_iter(
+                    snp, views, check_crcs):
                 yield (offset, msg)
 
+    @classmethod
+    def _decode_message_set_batch(cls, data, check_crcs=True):
+        """
+        Decode a MessageSet into a MessageBatch
+
+        Messages are walked in place and only their offsets and where
+        their keys and values are in data get recorded. The values of
+        compressed messages are decompressed and their messages recorded
+        as being after data, at the end of the batch's buffer.
+        """
+        batch = MessageBatch()
+        parts = [data]
+
+        def decode(data, base):
+            for (codec, value) in cls._decode_message_set_columns(
+                    batch, data, base, check_crcs):
+                if codec == CODEC_GZIP:
+                    inner = gzip_decode(value)
+                elif codec == CODEC_SNAPPY:
+                    inner = snappy_decode(value)
+                else:
+                    continue
+                inner_base = sum(len(part) for part in parts)
+                parts.append(inner)
+                # Before moving on, to keep the messages in order
+                decode(inner, inner_base)
+
+        decode(data, 0)
+        if len(parts) == 1:
+            batch.buffer = parts[0]
+        else:
+            batch.buffer = b"".join(bytes(part) for part in parts)
+        return batch
+
+    @classmethod
+    def _decode_message_set_columns(cls, batch, data, base, check_crcs):
+        """
+        Append the uncompressed messages of the MessageSet in data to batch,
+        with base added to their positions, and yield the codec and value
+        of each compressed one
+        """
+        offsets = batch.offsets
+        attributes = batch.attributes
+        key_starts, key_lengths = batch.key_starts, batch.key_lengths
+        value_starts, value_lengths = batch.value_starts, batch.value_lengths
+
+        cur = 0
+        end = len(data)
+        while cur < end:
+            start = cur + _MESSAGE_SET_ITEM.size
+            if start > end:
+                batch.truncated = True
+                break
+            (offset, size) = _MESSAGE_SET_ITEM.unpack(data[cur:start])
+            cur = start + size
+            if cur > end or size < _MESSAGE_HEADER_KEY_SIZE.size + INT32.size:
+                batch.truncated = True
+                break
+
+            (crc, magic, att, key_length) = _MESSAGE_HEADER_KEY_SIZE.unpack(
+                data[start:start + _MESSAGE_HEADER_KEY_SIZE.size])
+            if check_crcs:
+                crc_data = compat.view(data, start + 4, size - 4)
+                if crc != zlib.crc32(crc_data) & 0xffffffff:
+                    raise ChecksumError("Message checksum failed")
+
+            key_start = start + _MESSAGE_HEADER_KEY_SIZE.size
+            value_start = key_start + max(key_length, 0) + INT32.size
+            (value_length,) = INT32.unpack(data[value_start - INT32.size:
+                                                value_start])
+
+            codec = att & ATTRIBUTE_CODEC_MASK
+            if codec != CODEC_NONE:
+                yield (codec, bytes(data[value_start:
+                                         value_start + value_length]))
+                continue
+
+            offsets.append(offset)
+            attributes.append(att)
+            key_starts.append(base + key_start)
+            key_lengths.append(key_length)
+            value_starts.append(base + value_start)
+            value_lengths.append(value_length)
+
     ##################
     #   Public API   #
     ##################
@@ -201,21 +409,32 @@ class KafkaProtocol(object):
         payloads = [] if payloads is None else payloads
         grouped_payloads = group_by_topic_and_partition(payloads)
 
-        message = cls._encode_message_header(client_id, correlation_id,
-                                             KafkaProtocol.PRODUCE_KEY)
-
-        message += struct.pack('>hii', acks, timeout, len(grouped_payloads))
-
+        size = _ACKS_TIMEOUT_COUNT.size
+        topics = []
         for topic, topic_payloads in grouped_payloads.items():
-            message += struct.pack('>h%dsi' % len(topic),
-                                   len(topic), compat.bytes(topic), len(topic_payloads))
-
+            size += cls._short_string_size(topic) + INT32.size
+            partitions = []
             for partition, payload in topic_payloads.items():
-                msg_set = KafkaProtocol._encode_message_set(payload.messages)
-                message += struct.pack('>ii%ds' % len(msg_set), partition,
-                                       len(msg_set), msg_set)
-
-        return struct.pack('>i%ds' % len(message), len(message), message)
+                set_size = cls._message_set_size(payload.messages)
+                size += _INT32_INT32.size + set_size
+                partitions.append((partition, set_size, payload.messages))
+            topics.append((topic, partitions))
+
+        buf, cur = cls._request_buffer(client_id, correlation_id,
+                                       KafkaProtocol.PRODUCE_KEY, size)
+        _ACKS_TIMEOUT_COUNT.pack_into(buf, cur, acks, timeout, len(topics))
+        cur += _ACKS_TIMEOUT_COUNT.size
+
+        for topic, partitions in topics:
+            cur = cls._write_short_string(buf, cur, topic)
+            INT32.pack_into(buf, cur, len(partitions))
+            cur += INT32.size
+            for partition, set_size, messages in partitions:
+                _INT32_INT32.pack_into(buf, cur, partition, set_size)
+                cur = cls._write_message_set(buf, cur + _INT32_INT32.size,
+                                             messages)
+
+        return buf
 
     @classmethod
     def decode_produce_response(cls, data):
@@ -226,16 +445,15 @@ class KafkaProtocol(object):
         ======
         data: bytes to decode
         """
-        ((correlation_id, num_topics), cur) = relative_unpack('>ii', data, 0)
+        ((correlation_id, num_topics), cur) = relative_unpack_from(
+            _INT32_INT32, data, 0)
 
         for i in range(num_topics):
-            ((strlen,), cur) = relative_unpack('>h', data, cur)
-            topic = compat.str(data[cur:cur + strlen])
-            cur += strlen
-            ((num_partitions,), cur) = relative_unpack('>i', data, cur)
+            (topic, cur) = read_short_string(data, cur)
+            ((num_partitions,), cur) = relative_unpack_from(INT32, data, cur)
             for i in range(num_partitions):
-                ((partition, error, offset), cur) = relative_unpack('>ihq',
-                                                                    data, cur)
+                ((partition, error, offset), cur) = relative_unpack_from(
+                    _INT32_INT16_INT64, data, cur)
 
                 yield ProduceResponse(topic, partition, error, offset)
 
@@ -258,68 +476,102 @@ class KafkaProtocol(object):
         payloads = [] if payloads is None else payloads
         grouped_payloads = group_by_topic_and_partition(payloads)
 
-        message = cls._encode_message_header(client_id, correlation_id,
-                                             KafkaProtocol.FETCH_KEY)
+        size = _FETCH_REQUEST_HEADER.size
+        for topic, topic_payloads in grouped_payloads.items():
+            size += (cls._short_string_size(topic) + INT32.size +
+                     _INT32_INT64_INT32.size * len(topic_payloads))
+
+        buf, cur = cls._request_buffer(client_id, correlation_id,
+                                       KafkaProtocol.FETCH_KEY, size)
 
         # -1 is the replica id
-        message += struct.pack('>iiii', -1, max_wait_time, min_bytes,
-                               len(grouped_payloads))
+        _FETCH_REQUEST_HEADER.pack_into(buf, cur, -1, max_wait_time,
+                                        min_bytes, len(grouped_payloads))
+        cur += _FETCH_REQUEST_HEADER.size
 
         for topic, topic_payloads in grouped_payloads.items():
-            message += write_short_string(topic)
-            message += struct.pack('>i', len(topic_payloads))
+            cur = cls._write_short_string(buf, cur, topic)
+            INT32.pack_into(buf, cur, len(topic_payloads))
+            cur += INT32.size
             for partition, payload in topic_payloads.items():
-                message += struct.pack('>iqi', partition, payload.offset,
-                                       payload.max_bytes)
+                _INT32_INT64_INT32.pack_into(buf, cur, partition,
+                                             payload.offset, payload.max_bytes)
+                cur += _INT32_INT64_INT32.size
 
-        return struct.pack('>i%ds' % len(message), len(message), message)
+        return buf
 
     @classmethod
-    def decode_fetch_response(cls, data):
+    def decode_fetch_response(cls, data, views=False, check_crcs=True,
+                              columnar=False):
         """
         Decode bytes to a FetchResponse
 
         Params
         ======
         data: bytes to decode
-        """
-        ((correlation_id, num_topics), cur) = relative_unpack('>ii', data, 0)
+        views: boolean, hand out the keys and values of messages as
+               read-only views into data instead of copies of them. They
+               are memoryviews, or buffers on Python 2, and keep all of
+               data alive for as long as any of them is referenced.
+        check_crcs: boolean, verify the checksum of every message. Turning
+                    it off saves most of the cost of decoding large
+                    messages, but corruption then goes unnoticed.
+        columnar: boolean, decode the messages of each partition into a
+                  MessageBatch of columns rather than an iterator of
+                  OffsetAndMessage. views is ignored.
+        """
+        ((correlation_id, num_topics), cur) = relative_unpack_from(
+            _INT32_INT32, data, 0)
 
         for i in range(num_topics):
             (topic, cur) = read_short_string(data, cur)
-            ((num_partitions,), cur) = relative_unpack('>i', data, cur)
+            ((num_partitions,), cur) = relative_unpack_from(INT32, data, cur)
 
             for i in range(num_partitions):
                 ((partition, error, highwater_mark_offset), cur) = \
-                    relative_unpack('>ihq', data, cur)
+                    relative_unpack_from(_INT32_INT16_INT64, data, cur)
 
-                (message_set, cur) = read_int_string(data, cur)
+                (message_set, cur) = read_int_string(data, cur, view=True)
+
+                if columnar:
+                    messages = KafkaProtocol._decode_message_set_batch(
+                        message_set, check_crcs)
+                else:
+                    messages = KafkaProtocol._decode_message_set_iter(
+                        message_set, views, check_crcs)
 
                 yield FetchResponse(
                     topic, partition, error,
-                    highwater_mark_offset,
-                    KafkaProtocol._decode_message_set_iter(message_set))
+                    highwater_mark_offset, messages)
 
     @classmethod
     def encode_offset_request(cls, client_id, correlation_id, payloads=None):
         payloads = [] if payloads is None else payloads
         grouped_payloads = group_by_topic_and_partition(payloads)
 
-        message = cls._encode_message_header(client_id, correlation_id,
-                                             KafkaProtocol.OFFSET_KEY)
+        size = _INT32_INT32.size
+        for topic, topic_payloads in grouped_payloads.items():
+            size += (cls._short_string_size(topic) + INT32.size +
+                     _INT32_INT64_INT32.size * len(topic_payloads))
+
+        buf, cur = cls._request_buffer(client_id, correlation_id,
+                                       KafkaProtocol.OFFSET_KEY, size)
 
         # -1 is the replica id
-        message += struct.pack('>ii', -1, len(grouped_payloads))
+        _INT32_INT32.pack_into(buf, cur, -1, len(grouped_payloads))
+        cur += _INT32_INT32.size
 
         for topic, topic_payloads in grouped_payloads.items():
-            message += write_short_string(topic)
-            message += struct.pack('>i', len(topic_payloads))
+            cur = cls._write_short_string(buf, cur, topic)
+            INT32.pack_into(buf, cur, len(topic_payloads))
+            cur += INT32.size
 
             for partition, payload in topic_payloads.items():
-                message += struct.pack('>iqi', partition, payload.time,
-                                       payload.max_offsets)
+                _INT32_INT64_INT32.pack_into(buf, cur, partition, payload.time,
+                                             payload.max_offsets)
+                cur += _INT32_INT64_INT32.size
 
-        return struct.pack('>i%ds' % len(message), len(message), message)
+        return buf
 
     @classmethod
     def decode_offset_response(cls, data):
@@ -330,22 +582,21 @@ class KafkaProtocol(object):
         ======
         data: bytes to decode
         """
-        ((correlation_id, num_topics), cur) = relative_unpack('>ii', data, 0)
+        ((correlation_id, num_topics), cur) = relative_unpack_from(
+            _INT32_INT32, data, 0)
 
         for i in range(num_topics):
             (topic, cur) = read_short_string(data, cur)
-            ((num_partitions,), cur) = relative_unpack('>i', data, cur)
+            ((num_partitions,), cur) = relative_unpack_from(INT32, data, cur)
 
             for i in range(num_partitions):
                 ((partition, error, num_offsets,), cur) = \
-                    relative_unpack('>ihi', data, cur)
+                    relative_unpack_from(_INT32_INT16_INT32, data, cur)
 
-                offsets = []
-                for j in range(num_offsets):
-                    ((offset,), cur) = relative_unpack('>q', data, cur)
-                    offsets.append(offset)
+                (offsets, cur) = relative_unpack('>%dq' % num_offsets,
+                                                 data, cur)
 
-                yield OffsetResponse(topic, partition, error, tuple(offsets))
+                yield OffsetResponse(topic, partition, error, offsets)
 
     @classmethod
     def encode_metadata_request(cls, client_id, correlation_id, topics=None):
@@ -359,15 +610,18 @@ class KafkaProtocol(object):
         topics: list of strings
         """
         topics = [] if topics is None else topics
-        message = cls._encode_message_header(client_id, correlation_id,
-                                             KafkaProtocol.METADATA_KEY)
+        size = INT32.size + sum(cls._short_string_size(topic)
+                                for topic in topics)
+        buf, cur = cls._request_buffer(client_id, correlation_id,
+                                       KafkaProtocol.METADATA_KEY, size)
 
-        message += struct.pack('>i', len(topics))
+        INT32.pack_into(buf, cur, len(topics))
+        cur += INT32.size
 
         for topic in topics:
-            message += struct.pack('>h%ds' % len(topic), len(topic), compat.bytes(topic))
+            cur = cls._write_short_string(buf, cur, topic)
 
-        return write_int_string(message)
+        return buf
 
     @classmethod
     def decode_metadata_response(cls, data):
@@ -378,38 +632,39 @@ class KafkaProtocol(object):
         ======
         data: bytes to decode
         """
-        ((correlation_id, numbrokers), cur) = relative_unpack('>ii', data, 0)
+        ((correlation_id, numbrokers), cur) = relative_unpack_from(
+            _INT32_INT32, data, 0)
 
         # Broker info
         brokers = {}
         for i in range(numbrokers):
-            ((nodeId, ), cur) = relative_unpack('>i', data, cur)
+            ((nodeId, ), cur) = relative_unpack_from(INT32, data, cur)
             (host, cur) = read_short_string(data, cur)
-            ((port,), cur) = relative_unpack('>i', data, cur)
+            ((port,), cur) = relative_unpack_from(INT32, data, cur)
             brokers[nodeId] = BrokerMetadata(nodeId, host, port)
 
         # Topic info
-        ((num_topics,), cur) = relative_unpack('>i', data, cur)
+        ((num_topics,), cur) = relative_unpack_from(INT32, data, cur)
         topic_metadata = {}
 
         for i in range(num_topics):
             # NOTE: topic_error is discarded. Should probably be returned with
             # the topic metadata.
-            ((topic_error,), cur) = relative_unpack('>h', data, cur)
+            ((topic_error,), cur) = relative_unpack_from(INT16, data, cur)
             (topic_name, cur) = read_short_string(data, cur)
-            ((num_partitions,), cur) = relative_unpack('>i', data, cur)
+            ((num_partitions,), cur) = relative_unpack_from(INT32, data, cur)
             partition_metadata = {}
 
             for j in range(num_partitions):
                 # NOTE: partition_error_code is discarded. Should probably be
                 # returned with the partition metadata.
                 ((partition_error_code, partition, leader, numReplicas), cur) = \
-                    relative_unpack('>hiii', data, cur)
+                    relative_unpack_from(_PARTITION_METADATA, data, cur)
 
                 (replicas, cur) = relative_unpack(
                     '>%di' % numReplicas, data, cur)
 
-                ((num_isr,), cur) = relative_unpack('>i', data, cur)
+                ((num_isr,), cur) = relative_unpack_from(INT32, data, cur)
                 (isr, cur) = relative_unpack('>%di' % num_isr, data, cur)
 
                 partition_metadata[partition] = \
@@ -435,20 +690,30 @@ class KafkaProtocol(object):
         """
         grouped_payloads = group_by_topic_and_partition(payloads)
 
-        message = cls._encode_message_header(client_id, correlation_id,
-                                             KafkaProtocol.OFFSET_COMMIT_KEY)
-        message += write_short_string(group)
-        message += struct.pack('>i', len(grouped_payloads))
+        size = cls._short_string_size(group) + INT32.size
+        for topic, topic_payloads in grouped_payloads.items():
+            size += cls._short_string_size(topic) + INT32.size
+            for payload in topic_payloads.values():
+                size += (_INT32_INT64.size +
+                         cls._short_string_size(payload.metadata))
+
+        buf, cur = cls._request_buffer(client_id, correlation_id,
+                                       KafkaProtocol.OFFSET_COMMIT_KEY, size)
+        cur = cls._write_short_string(buf, cur, group)
+        INT32.pack_into(buf, cur, len(grouped_payloads))
+        cur += INT32.size
 
         for topic, topic_payloads in grouped_payloads.items():
-            message += write_short_string(topic)
-            message += struct.pack('>i', len(topic_payloads))
+            cur = cls._write_short_string(buf, cur, topic)
+            INT32.pack_into(buf, cur, len(topic_payloads))
+            cur += INT32.size
 
             for partition, payload in topic_payloads.items():
-                message += struct.pack('>iq', partition, payload.offset)
-                message += write_short_string(payload.metadata)
+                _INT32_INT64.pack_into(buf, cur, partition, payload.offset)
+                cur = cls._write_short_string(buf, cur + _INT32_INT64.size,
+                                              payload.metadata)
 
-        return struct.pack('>i%ds' % len(message), len(message), message)
+        return buf
 
     @classmethod
     def decode_offset_commit_response(cls, data):
@@ -459,15 +724,16 @@ class KafkaProtocol(object):
         ======
         data: bytes to decode
         """
-        ((correlation_id,), cur) = relative_unpack('>i', data, 0)
-        ((num_topics,), cur) = relative_unpack('>i', data, cur)
+        ((correlation_id, num_topics), cur) = relative_unpack_from(
+            _INT32_INT32, data, 0)
 
         for i in compat.xrange(num_topics):
             (topic, cur) = read_short_string(data, cur)
-            ((num_partitions,), cur) = relative_unpack('>i', data, cur)
+            ((num_partitions,), cur) = relative_unpack_from(INT32, data, cur)
 
             for i in compat.xrange(num_partitions):
-                ((partition, error), cur) = relative_unpack('>ih', data, cur)
+                ((partition, error), cur) = relative_unpack_from(
+                    _INT32_INT16, data, cur)
                 yield OffsetCommitResponse(topic, partition, error)
 
     @classmethod
@@ -484,20 +750,28 @@ class KafkaProtocol(object):
         payloads: list of OffsetFetchRequest
         """
         grouped_payloads = group_by_topic_and_partition(payloads)
-        message = cls._encode_message_header(client_id, correlation_id,
-                                             KafkaProtocol.OFFSET_FETCH_KEY)
 
-        message += write_short_string(group)
-        message += struct.pack('>i', len(grouped_payloads))
+        size = cls._short_string_size(group) + INT32.size
+        for topic, topic_payloads in grouped_payloads.items():
+            size += (cls._short_string_size(topic) + INT32.size +
+                     INT32.size * len(topic_payloads))
+
+        buf, cur = cls._request_buffer(client_id, correlation_id,
+                                       KafkaProtocol.OFFSET_FETCH_KEY, size)
+        cur = cls._write_short_string(buf, cur, group)
+        INT32.pack_into(buf, cur, len(grouped_payloads))
+        cur += INT32.size
 
         for topic, topic_payloads in grouped_payloads.items():
-            message += write_short_string(topic)
-            message += struct.pack('>i', len(topic_payloads))
+            cur = cls._write_short_string(buf, cur, topic)
+            INT32.pack_into(buf, cur, len(topic_payloads))
+            cur += INT32.size
 
             for partition, payload in topic_payloads.items():
-                message += struct.pack('>i', partition)
+                INT32.pack_into(buf, cur, partition)
+                cur += INT32.size
 
-        return struct.pack('>i%ds' % len(message), len(message), message)
+        return buf
 
     @classmethod
     def decode_offset_fetch_response(cls, data):
@@ -509,22 +783,113 @@ class KafkaProtocol(object):
         data: bytes to decode
         """
 
-        ((correlation_id,), cur) = relative_unpack('>i', data, 0)
-        ((num_topics,), cur) = relative_unpack('>i', data, cur)
+        ((correlation_id, num_topics), cur) = relative_unpack_from(
+            _INT32_INT32, data, 0)
 
         for i in range(num_topics):
             (topic, cur) = read_short_string(data, cur)
-            ((num_partitions,), cur) = relative_unpack('>i', data, cur)
+            ((num_partitions,), cur) = relative_unpack_from(INT32, data, cur)
 
             for i in range(num_partitions):
-                ((partition, offset), cur) = relative_unpack('>iq', data, cur)
+                ((partition, offset), cur) = relative_unpack_from(
+                    _INT32_INT64, data, cur)
                 (metadata, cur) = read_short_string(data, cur)
-                ((error,), cur) = relative_unpack('>h', data, cur)
+                ((error,), cur) = relative_unpack_from(INT16, data, cur)
 
                 yield OffsetFetchResponse(topic, partition, offset,
                                           metadata, error)
 
 
+class MessageBatch(object):
+    """
+    The messages of one partition of a FetchResponse, decoded into columns
+
+    offsets:       the offset of each message, an array of int64
+    attributes:    the attributes byte of each message
+    key_starts,
+    key_lengths,
+    value_starts,
+    value_lengths: arrays of int32 giving where the key and value of each
+                   message are in buffer. A length of -1 is a null.
+    buffer:        the message set the messages were decoded from, with the
+                   decompressed contents of any compressed messages after it
+    truncated:     whether the message set ended with a partial message
+
+    Only the positions of keys and values are decoded, not the keys and
+    values themselves, so a batch costs a few array entries per message
+    rather than Python objects. Iterating a batch yields OffsetAndMessage
+    like the iterator decode_fetch_response returns otherwise.
+    """
+    def __init__(self):
+        self.offsets = (array(_INT64_TYPECODE) if _INT64_TYPECODE is not None
+                        else [])
+        self.attributes = array('B')
+        self.key_starts = array('i')
+        self.key_lengths = array('i')
+        self.value_starts = array('i')
+        self.value_lengths = array('i')
+        self.buffer = b""
+        self.truncated = False
+
+    def __repr__(self):
+        return '<MessageBatch messages=%d>' % len(self)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        if self.truncated and not self.offsets:
+            # As when iterating the messages of a partial message set
+            raise ConsumerFetchSizeTooSmall()
+
+        for i in compat.xrange(len(self)):
+            yield OffsetAndMessage(
+                self.offsets[i],
+                Message(0, self.attributes[i], self.key(i), self.value(i)))
+
+    def _read(self, start, length):
+        if length == -1:
+            return None
+        return bytes(self.buffer[start:start + length])
+
+    def key(self, i):
+        """
+        The key of the i-th message as bytes, or None
+        """
+        return self._read(self.key_starts[i], self.key_lengths[i])
+
+    def value(self, i):
+        """
+        The value of the i-th message as bytes, or None
+        """
+        return self._read(self.value_starts[i], self.value_lengths[i])
+
+    def to_numpy(self):
+        """
+        Return the columns as a dict of NumPy arrays, sharing memory with
+        the batch, plus the buffer as an array of uint8 under 'buffer'
+
+        Raises ImportError if NumPy is not installed.
+        """
+        if not _has_numpy:
+            raise ImportError("NumPy is not available")
+
+        columns = dict(
+            (name, numpy.frombuffer(getattr(self, name), dtype=dtype))
+            for (name, dtype) in (('attributes', numpy.uint8),
+                                  ('key_starts', numpy.int32),
+                                  ('key_lengths', numpy.int32),
+                                  ('value_starts', numpy.int32),
+                                  ('value_lengths', numpy.int32)))
+        if isinstance(self.offsets, array):
+            columns['offsets'] = numpy.frombuffer(self.offsets,
+                                                  dtype=numpy.int64)
+        else:
+            columns['offsets'] = numpy.array(self.offsets, dtype=numpy.int64)
+        columns['buffer'] = numpy.frombuffer(self.buffer, dtype=numpy.uint8)
+        return columns
+
+
 def create_message(payload, key=None):
     """
     Construct a Message
@@ -552,7 +917,7 @@ def create_gzip_message(payloads, key=None):
     message_set = KafkaProtocol._encode_message_set(
         [create_message(payload) for payload in payloads])
 
-    gzipped = gzip_encode(message_set)
+    gzipped = gzip_encode(compat.view(message_set, 0, len(message_set)))
     codec = ATTRIBUTE_CODEC_MASK & CODEC_GZIP
 
     return Message(0, 0x00 | codec, key, gzipped)
@@ -573,7 +938,7 @@ def create_snappy_message(payloads, key=None):
     message_set = KafkaProtocol._encode_message_set(
         [create_message(payload) for payload in payloads])
 
-    snapped = snappy_encode(message_set)
+    snapped = snappy_encode(compat.view(message_set, 0, len(message_set)))
     codec = ATTRIBUTE_CODEC_MASK & CODEC_SNAPPY
 
     return Message(0, 0x00 | codec, key, snapped)
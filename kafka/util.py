@@ -7,28 +7,46 @@ from kafka import compat
 from kafka.common import BufferUnderflowError
 
 
+_structs = {}
+
+
+def get_struct(fmt):
+    """
+    Return a precompiled struct.Struct for fmt, compiling it on first use
+    """
+    compiled = _structs.get(fmt)
+    if compiled is None:
+        compiled = _structs[fmt] = struct.Struct(fmt)
+    return compiled
+
+
+INT16 = get_struct('>h')
+INT32 = get_struct('>i')
+INT64 = get_struct('>q')
+
+
 def write_int_string(s):
     if s is None:
-        return struct.pack('>i', -1)
+        return INT32.pack(-1)
     else:
-        return struct.pack('>i%ds' % len(s), len(s), s)
+        return INT32.pack(len(s)) + s
 
 
 def write_short_string(s):
     if s is None:
-        return struct.pack('>h', -1)
+        return INT16.pack(-1)
     elif len(s) > 32767 and sys.version < '2.7':
         # Python 2.6 issues a deprecation warning instead of a struct error
         raise struct.error(len(s))
     else:
-        return struct.pack('>h%ds' % len(s), len(s), compat.bytes(s))
+        return INT16.pack(len(s)) + compat.bytes(s)
 
 
 def read_short_string(data, cur):
     if len(data) < cur + 2:
         raise BufferUnderflowError("Not enough data left")
 
-    (strlen,) = struct.unpack('>h', data[cur:cur + 2])
+    (strlen,) = INT16.unpack(data[cur:cur + 2])
     if strlen == -1:
         return None, cur + 2
 
@@ -40,13 +58,19 @@ def read_short_string(data, cur):
     return compat.str(out), cur + strlen
 
 
-def read_int_string(data, cur):
+def read_int_string(data, cur, view=False):
+    """
+    Read an int32 length-prefixed string at cur in data
+
+    With view set, a read-only view of the string in data is returned
+    rather than a copy of it.
+    """
     if len(data) < cur + 4:
         raise BufferUnderflowError(
             "Not enough data left to read string len (%d < %d)" %
             (len(data), cur + 4))
 
-    (strlen,) = struct.unpack('>i', data[cur:cur + 4])
+    (strlen,) = INT32.unpack(data[cur:cur + 4])
     if strlen == -1:
         return None, cur + 4
 
@@ -54,17 +78,30 @@ def read_int_string(data, cur):
     if len(data) < cur + strlen:
         raise BufferUnderflowError("Not enough data left")
 
-    out = data[cur:cur + strlen]
+    if view:
+        out = compat.view(data, cur, strlen)
+    else:
+        # data may be a view onto a response buffer; hand out real bytes
+        out = bytes(data[cur:cur + strlen])
     return out, cur + strlen
 
 
 def relative_unpack(fmt, data, cur):
-    size = struct.calcsize(fmt)
-    if len(data) < cur + size:
+    return relative_unpack_from(get_struct(fmt), data, cur)
+
+
+def relative_unpack_from(compiled, data, cur):
+    """
+    relative_unpack for a precompiled struct.Struct
+
+    Unpacking a slice is cheaper than unpack_from(), which has to parse
+    keyword arguments on every call.
+    """
+    end = cur + compiled.size
+    if len(data) < end:
         raise BufferUnderflowError("Not enough data left")
 
-    out = struct.unpack(fmt, data[cur:cur + size])
-    return out, cur + size
+    return compiled.unpack(data[cur:end]), end
 
 
 def group_by_topic_and_partition(tuples):
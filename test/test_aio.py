@@ -0,0 +1,160 @@
+import struct
+import unittest2
+
+try:
+    import asyncio
+    from kafka.aio import (
+        AIOKafkaConnection, AIOKafkaClient, AIOSimpleProducer
+    )
+except (ImportError, SyntaxError):  # Python < 3.4
+    asyncio = None
+
+from kafka.common import ConnectionError, ProduceResponse
+from kafka.protocol import KafkaProtocol
+
+
+def encode_short_string(s):
+    return struct.pack('>h%ds' % len(s), len(s), s.encode('ascii'))
+
+
+class FakeBroker(object):
+    """
+    A single-partition Kafka broker answering metadata and produce requests
+
+    If batch is set, responses are held until that many requests have been
+    read and then sent in reverse order.
+    """
+    def __init__(self, loop, batch=1):
+        self.loop = loop
+        self.batch = batch
+        self.requests = []
+        self.server = loop.run_until_complete(
+            loop.create_server(lambda: _FakeBrokerProtocol(self),
+                               '127.0.0.1', 0))
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    def respond(self, api_key, correlation_id):
+        if api_key == KafkaProtocol.METADATA_KEY:
+            body = b''.join([
+                struct.pack('>ii', 1, 0),
+                encode_short_string('127.0.0.1'),
+                struct.pack('>i', self.port),
+                struct.pack('>ih', 1, 0),
+                encode_short_string('topic'),
+                struct.pack('>ihiiiii', 1, 0, 0, 0, 1, 0, 1) + struct.pack('>i', 0),
+            ])
+        else:
+            body = b''.join([
+                struct.pack('>i', 1),
+                encode_short_string('topic'),
+                struct.pack('>iihq', 1, 0, 0, correlation_id),
+            ])
+        return struct.pack('>ii', len(body) + 4, correlation_id) + body
+
+    def close(self):
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+
+
+class _FakeBrokerProtocol(object if asyncio is None else asyncio.Protocol):
+    def __init__(self, broker):
+        self.broker = broker
+        self.data = b''
+        self.pending = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.data += data
+        while len(self.data) >= 4:
+            (size,) = struct.unpack('>i', self.data[:4])
+            if len(self.data) < size + 4:
+                break
+            request, self.data = self.data[4:size + 4], self.data[size + 4:]
+            (api_key, _, correlation_id) = struct.unpack('>hhi', request[:8])
+            self.broker.requests.append((api_key, correlation_id))
+            self.pending.append(self.broker.respond(api_key, correlation_id))
+
+            if len(self.pending) >= self.broker.batch:
+                for response in reversed(self.pending):
+                    self.transport.write(response)
+                self.pending = []
+
+
+@unittest2.skipIf(asyncio is None, "asyncio not available")
+class TestAIOKafka(unittest2.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_connection_matches_responses_by_correlation_id(self):
+        broker = FakeBroker(self.loop, batch=3)
+        conn = AIOKafkaConnection('127.0.0.1', broker.port, loop=self.loop)
+
+        requests = []
+        for correlation_id in (7, 8, 9):
+            request = KafkaProtocol.encode_metadata_request(
+                'client', correlation_id, [])
+            requests.append(conn.request(correlation_id, request))
+
+        responses = self.loop.run_until_complete(
+            asyncio.gather(*requests, loop=self.loop))
+
+        self.assertEqual([struct.unpack('>i', r[:4])[0] for r in responses],
+                         [7, 8, 9])
+
+        conn.close()
+        broker.close()
+
+    def test_connection_reconnects_after_failed_send(self):
+        broker = FakeBroker(self.loop)
+        conn = AIOKafkaConnection('127.0.0.1', broker.port, loop=self.loop)
+        request = KafkaProtocol.encode_metadata_request('client', 1, [])
+        self.loop.run_until_complete(conn.request(1, request))
+
+        @asyncio.coroutine
+        def broken_drain():
+            raise OSError('broken pipe')
+        conn._writer.drain = broken_drain
+        old_read_task = conn._read_task
+
+        request = KafkaProtocol.encode_metadata_request('client', 2, [])
+        with self.assertRaises(ConnectionError):
+            self.loop.run_until_complete(conn.request(2, request))
+
+        # Let the old reader see its stream close before reconnecting
+        self.loop.run_until_complete(asyncio.sleep(0.1, loop=self.loop))
+        self.assertTrue(old_read_task.cancelled())
+
+        request = KafkaProtocol.encode_metadata_request('client', 3, [])
+        resp = self.loop.run_until_complete(conn.request(3, request))
+        self.assertEqual(struct.unpack('>i', resp[:4])[0], 3)
+        self.assertIsNotNone(conn._reader)
+
+        conn.close()
+        broker.close()
+
+    def test_concurrent_producers_share_one_metadata_request(self):
+        broker = FakeBroker(self.loop)
+        client = AIOKafkaClient('127.0.0.1:%d' % broker.port, loop=self.loop)
+        producer = AIOSimpleProducer(client)
+
+        sends = [producer.send_messages('topic', ('message %d' % i).encode())
+                 for i in range(5)]
+        results = self.loop.run_until_complete(
+            asyncio.gather(*sends, loop=self.loop))
+
+        for (resp,) in results:
+            self.assertIsInstance(resp, ProduceResponse)
+            self.assertEqual((resp.topic, resp.partition, resp.error),
+                             ('topic', 0, 0))
+
+        api_keys = [api_key for (api_key, _) in broker.requests]
+        self.assertEqual(api_keys.count(KafkaProtocol.METADATA_KEY), 1)
+        self.assertEqual(api_keys.count(KafkaProtocol.PRODUCE_KEY), 5)
+
+        client.close()
+        broker.close()
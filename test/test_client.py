@@ -1,15 +1,22 @@
 import os
 import random
+import shutil
+import socket
 import struct
+import tempfile
+import threading
+import time
 import unittest2
 
 from mock import MagicMock, patch
 
-from kafka import KafkaClient
+import kafka.client
+from kafka import KafkaClient, KafkaConnection
 from kafka.common import (
-    ProduceRequest, BrokerMetadata, PartitionMetadata,
-    TopicAndPartition, KafkaUnavailableError,
-    LeaderUnavailableError, PartitionUnavailableError
+    ProduceRequest, ProduceResponse, FetchRequest, FetchResponse,
+    BrokerMetadata, PartitionMetadata,
+    TopicAndPartition, KafkaUnavailableError, ConnectionError,
+    FailedPayloadsError, LeaderUnavailableError, PartitionUnavailableError
 )
 from kafka.protocol import (
     create_message, KafkaProtocol
@@ -93,7 +100,7 @@ class TestKafkaClient(unittest2.TestCase):
                 self.assertEqual('valid response', resp)
                 mocked_conns[('kafka02', 9092)].recv.assert_called_with(1)
 
-    @patch('kafka.client.KafkaConnection')
+    @patch('kafka.conn.KafkaConnection')
     @patch('kafka.client.KafkaProtocol')
     def test_load_metadata(self, protocol, conn):
         "Load metadata for all topics"
@@ -131,7 +138,7 @@ class TestKafkaClient(unittest2.TestCase):
             TopicAndPartition('topic_3', 2): brokers[0]},
             client.topics_to_brokers)
 
-    @patch('kafka.client.KafkaConnection')
+    @patch('kafka.conn.KafkaConnection')
     @patch('kafka.client.KafkaProtocol')
     def test_get_leader_for_partitions_reloads_metadata(self, protocol, conn):
         "Get leader for partitions reload metadata if it is not available"
@@ -164,7 +171,7 @@ class TestKafkaClient(unittest2.TestCase):
             TopicAndPartition('topic_no_partitions', 0): brokers[0]},
             client.topics_to_brokers)
 
-    @patch('kafka.client.KafkaConnection')
+    @patch('kafka.conn.KafkaConnection')
     @patch('kafka.client.KafkaProtocol')
     def test_get_leader_for_unassigned_partitions(self, protocol, conn):
         "Get leader raises if no partitions is defined for a topic"
@@ -185,7 +192,7 @@ class TestKafkaClient(unittest2.TestCase):
         with self.assertRaises(PartitionUnavailableError):
             client._get_leader_for_partition('topic_no_partitions', 0)
 
-    @patch('kafka.client.KafkaConnection')
+    @patch('kafka.conn.KafkaConnection')
     @patch('kafka.client.KafkaProtocol')
     def test_get_leader_returns_none_when_noleader(self, protocol, conn):
         "Getting leader for partitions returns None when the partiion has no leader"
@@ -221,7 +228,7 @@ class TestKafkaClient(unittest2.TestCase):
         self.assertEqual(brokers[0], client._get_leader_for_partition('topic_noleader', 0))
         self.assertEqual(brokers[1], client._get_leader_for_partition('topic_noleader', 1))
 
-    @patch('kafka.client.KafkaConnection')
+    @patch('kafka.conn.KafkaConnection')
     @patch('kafka.client.KafkaProtocol')
     def test_send_produce_request_raises_when_noleader(self, protocol, conn):
         "Send producer request raises LeaderUnavailableError if leader is not available"
@@ -248,3 +255,619 @@ class TestKafkaClient(unittest2.TestCase):
         with self.assertRaises(LeaderUnavailableError):
             client.send_produce_request(requests)
 
+
+    @unittest2.skipIf(kafka.client.selectors is None, "selectors not available")
+    def test_iter_responses_yields_in_arrival_order(self):
+        "Responses are read from whichever broker answers first"
+
+        conns, peers = [], []
+        for port in (9092, 9093):
+            sock, peer = socket.socketpair()
+            conn = KafkaConnection('localhost', port)
+            with patch.object(KafkaConnection, '_create_socket', return_value=sock):
+                conn.reinit()
+            conns.append(conn)
+            peers.append(peer)
+
+        with patch.object(KafkaClient, 'load_metadata_for_topics'):
+            client = KafkaClient(hosts=['broker_1:4567'])
+
+        in_flight = [(conns[0], 1), (conns[1], 2)]
+        responses = client._iter_responses(in_flight)
+
+        peers[1].sendall(struct.pack('>ii', 4, 2))
+        (entry, response) = next(responses)
+        self.assertEqual(entry, (conns[1], 2))
+        self.assertEqual(bytes(response), struct.pack('>i', 2))
+
+        peers[0].sendall(struct.pack('>ii', 4, 1))
+        (entry, response) = next(responses)
+        self.assertEqual(entry, (conns[0], 1))
+        self.assertEqual(bytes(response), struct.pack('>i', 1))
+
+        self.assertEqual(list(responses), [])
+
+        for sock in conns + peers:
+            sock.close()
+
+    def test_send_broker_unaware_request_skips_hosts_in_backoff(self):
+        'Hosts that failed recently are tried after the others'
+
+        mocked_conns = {
+            ('kafka01', 9092): MagicMock(),
+            ('kafka02', 9092): MagicMock()
+        }
+        mocked_conns[('kafka02', 9092)].recv.return_value = 'valid response'
+
+        def mock_get_conn(host, port):
+            return mocked_conns[(host, port)]
+
+        with patch.object(KafkaClient, 'load_metadata_for_topics'):
+            client = KafkaClient(hosts=['kafka01:9092', 'kafka02:9092'])
+
+        client.hosts = [('kafka01', 9092), ('kafka02', 9092)]
+        client._get_pool('kafka01', 9092)._retry_at = float('inf')
+
+        with patch.object(KafkaClient, '_get_conn', side_effect=mock_get_conn):
+            resp = client._send_broker_unaware_request(1, 'fake request')
+
+        self.assertEqual('valid response', resp)
+        self.assertFalse(mocked_conns[('kafka01', 9092)].send.called)
+
+    def test_get_metrics(self):
+        with patch.object(KafkaClient, 'load_metadata_for_topics'):
+            client = KafkaClient(hosts=['kafka01:9092'], metrics=True)
+            disabled = KafkaClient(hosts=['kafka01:9092'])
+
+        client._get_pool('kafka01', 9092).metrics.incr('requests')
+        disabled._get_pool('kafka01', 9092)
+
+        self.assertEqual(client.get_metrics()[('kafka01', 9092)]['requests'], 1)
+        self.assertEqual(disabled.get_metrics(), {})
+
+        client.reset_metrics()
+        self.assertEqual(client.get_metrics()[('kafka01', 9092)]['requests'], 0)
+
+    def test_send_failure_refreshes_only_topics_of_failed_broker(self):
+        "A broker failing only reloads the metadata of the topics it leads"
+
+        broker_1 = BrokerMetadata(0, 'broker_1', 4567)
+        broker_2 = BrokerMetadata(1, 'broker_2', 5678)
+
+        with patch.object(KafkaClient, 'load_metadata_for_topics'):
+            client = KafkaClient(hosts=['broker_1:4567'])
+
+        client.topic_partitions = {'topic_a': [0, 1], 'topic_b': [0]}
+        client.topics_to_brokers = {
+            TopicAndPartition('topic_a', 0): broker_1,
+            TopicAndPartition('topic_a', 1): broker_2,
+            TopicAndPartition('topic_b', 0): broker_2,
+        }
+
+        def mock_get_conn(host, port):
+            conn = MagicMock()
+            if host == 'broker_1':
+                conn.send.side_effect = ConnectionError('broker_1 went away')
+            return conn
+
+        requests = [ProduceRequest('topic_a', 0, [create_message(b'a')]),
+                    ProduceRequest('topic_b', 0, [create_message(b'b')])]
+
+        with patch.object(KafkaClient, '_get_conn', side_effect=mock_get_conn), \
+                patch.object(KafkaClient, 'load_metadata_for_topics') as load:
+            with self.assertRaises(FailedPayloadsError):
+                client.send_produce_request(requests, acks=0)
+
+        load.assert_called_once_with('topic_a')
+        self.assertNotIn(TopicAndPartition('topic_a', 0), client.topics_to_brokers)
+        self.assertEqual(client.topics_to_brokers[TopicAndPartition('topic_a', 1)],
+                         broker_2)
+        self.assertEqual(client.topics_to_brokers[TopicAndPartition('topic_b', 0)],
+                         broker_2)
+
+    def test_concurrent_metadata_loads_share_one_request(self):
+        "Threads missing the same metadata wait for a single request"
+
+        with patch.object(KafkaClient, 'load_metadata_for_topics'):
+            client = KafkaClient(hosts=['broker_1:4567'])
+
+        release = threading.Event()
+        calls = []
+
+        def load(topics):
+            calls.append(topics)
+            release.wait(5)
+
+        with patch.object(client, '_load_metadata_for_topics', side_effect=load):
+            threads = [threading.Thread(target=client.load_metadata_for_topics,
+                                        args=('topic',))
+                       for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.1)
+            release.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(calls, [('topic',)])
+        self.assertEqual(client._metadata_loads, {})
+
+    def test_load_for_one_topic_waits_for_load_including_it(self):
+        "A miss during a refresh of more topics waits for that refresh"
+
+        with patch.object(KafkaClient, 'load_metadata_for_topics'):
+            client = KafkaClient(hosts=['broker_1:4567'])
+
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def load(topics):
+            calls.append(tuple(topics))
+            started.set()
+            release.wait(5)
+
+        with patch.object(client, '_load_metadata_for_topics', side_effect=load):
+            refresh = threading.Thread(target=client.load_metadata_for_topics,
+                                       args=('topic_a', 'topic_b'))
+            refresh.start()
+            started.wait(5)
+            miss = threading.Thread(target=client.load_metadata_for_topics,
+                                    args=('topic_b',))
+            miss.start()
+            time.sleep(0.1)
+            release.set()
+            refresh.join()
+            miss.join()
+
+        self.assertEqual(calls, [('topic_a', 'topic_b')])
+
+    @patch('kafka.conn.KafkaConnection')
+    @patch('kafka.client.KafkaProtocol')
+    def test_load_metadata_swaps_in_new_metadata(self, protocol, conn):
+        "Reloading a topic never leaves it missing from the metadata in use"
+
+        conn.recv.return_value = 'response'  # anything but None
+
+        brokers = {0: BrokerMetadata(0, 'broker_1', 4567),
+                   1: BrokerMetadata(1, 'broker_2', 5678)}
+        topics = {'topic': {0: PartitionMetadata('topic', 0, 0, [0], [0])}}
+        protocol.decode_metadata_response.return_value = (brokers, topics)
+        client = KafkaClient(hosts=['broker_1:4567'])
+
+        old = client.topics_to_brokers
+        topics['topic'] = {0: PartitionMetadata('topic', 0, 1, [1], [1])}
+        client._refresh_metadata()
+
+        self.assertEqual(old, {TopicAndPartition('topic', 0): brokers[0]})
+        self.assertEqual(client.topics_to_brokers,
+                         {TopicAndPartition('topic', 0): brokers[1]})
+        self.assertEqual(client._get_leader_for_partition('topic', 0),
+                         brokers[1])
+
+    def test_get_leader_reloads_expired_metadata(self):
+        "Metadata older than metadata_max_age is reloaded on use"
+
+        broker = BrokerMetadata(0, 'broker_1', 4567)
+        with patch.object(KafkaClient, 'load_metadata_for_topics'):
+            client = KafkaClient(hosts=['broker_1:4567'], metadata_max_age=60)
+
+        client.topic_partitions = {'topic': [0]}
+        client.topics_to_brokers = {TopicAndPartition('topic', 0): broker}
+        client.topics_loaded_at = {'topic': time.time()}
+
+        with patch.object(client, 'load_metadata_for_topics') as load:
+            self.assertEqual(client._get_leader_for_partition('topic', 0), broker)
+            self.assertFalse(load.called)
+
+            client.topics_loaded_at['topic'] -= 120
+            client._get_leader_for_partition('topic', 0)
+            load.assert_called_once_with('topic')
+
+    def test_copy_has_its_own_metadata_lock(self):
+        with patch.object(KafkaClient, 'load_metadata_for_topics'):
+            client = KafkaClient(hosts=['broker_1:4567'],
+                                 metadata_refresh_interval=60)
+        client.close()
+
+        copied = client.copy()
+        self.assertIsNot(copied._metadata_lock, client._metadata_lock)
+        self.assertIsNone(copied._refresh_timer)
+
+    def test_init_without_bootstrap_loads_metadata_on_first_use(self):
+        broker = BrokerMetadata(0, 'broker_1', 4567)
+
+        with patch.object(KafkaClient, '_load_metadata_for_topics') as load:
+            client = KafkaClient(hosts=['broker_1:4567'],
+                                 bootstrap_metadata=False)
+            self.assertFalse(load.called)
+            self.assertEqual(client.conns, {})
+
+            def load_topic(topics):
+                client.topic_partitions['topic'] = [0]
+                client.topics_to_brokers[TopicAndPartition('topic', 0)] = broker
+            load.side_effect = load_topic
+
+            self.assertEqual(client._get_leader_for_partition('topic', 0), broker)
+            load.assert_called_once_with(('topic',))
+
+    def test_metadata_snapshot_round_trip(self):
+        "Metadata saved by one client is used by the next instead of loading"
+
+        brokers = {
+            0: BrokerMetadata(0, 'broker_1', 4567),
+            1: BrokerMetadata(1, 'broker_2', 5678),
+        }
+        topics = {
+            'topic_1': {
+                0: PartitionMetadata('topic_1', 0, 1, [1, 0], [1, 0]),
+                1: PartitionMetadata('topic_1', 1, -1, [], []),
+            },
+        }
+
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'metadata.json')
+        try:
+            with patch.object(KafkaClient, '_send_broker_unaware_request'), \
+                    patch('kafka.client.KafkaProtocol') as protocol:
+                protocol.decode_metadata_response.return_value = (brokers, topics)
+                client = KafkaClient(hosts=['broker_1:4567'],
+                                     metadata_snapshot=path)
+            self.assertEqual(os.listdir(directory), ['metadata.json'])
+
+            with patch.object(KafkaClient, '_load_metadata_for_topics') as load:
+                warm = KafkaClient(hosts=['broker_1:4567'],
+                                   metadata_snapshot=path)
+            self.assertFalse(load.called)
+
+            self.assertEqual(warm.brokers, client.brokers)
+            self.assertEqual(warm.topics_to_brokers, client.topics_to_brokers)
+            self.assertEqual(sorted(warm.topic_partitions['topic_1']), [0, 1])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_metadata_snapshot_unreadable_falls_back_to_bootstrap(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'metadata.json')
+        with open(path, 'w') as f:
+            f.write('{not json')
+        try:
+            with patch.object(KafkaClient, 'load_metadata_for_topics') as load:
+                KafkaClient(hosts=['broker_1:4567'], metadata_snapshot=path)
+            load.assert_called_once_with()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_send_broker_aware_request_retries_failed_payloads(self):
+        "Only the payloads of a failed broker are resent, to the new leader"
+
+        broker_1 = BrokerMetadata(0, 'broker_1', 4567)
+        broker_2 = BrokerMetadata(1, 'broker_2', 5678)
+
+        with patch.object(KafkaClient, 'load_metadata_for_topics'):
+            client = KafkaClient(hosts=['broker_1:4567'], retries=2,
+                                 retry_backoff=0)
+
+        client.topic_partitions = {'topic': [0, 1]}
+        client.topics_to_brokers = {
+            TopicAndPartition('topic', 0): broker_1,
+            TopicAndPartition('topic', 1): broker_2,
+        }
+
+        sent = []
+
+        def mock_get_conn(host, port):
+            conn = MagicMock()
+            if host == 'broker_1':
+                conn.send.side_effect = ConnectionError('broker_1 went away')
+            else:
+                def send(request_id, request):
+                    sent.append(request)
+                    conn.recv.return_value = request
+                conn.send.side_effect = send
+            return conn
+
+        def failover(*topics):
+            client.topics_to_brokers[TopicAndPartition('topic', 0)] = broker_2
+
+        payloads = [ProduceRequest('topic', 0, []), ProduceRequest('topic', 1, [])]
+        with patch.object(KafkaClient, '_get_conn', side_effect=mock_get_conn), \
+                patch.object(KafkaClient, 'load_metadata_for_topics',
+                             side_effect=failover):
+            resps = list(client._send_broker_aware_request(
+                payloads,
+                lambda client_id, correlation_id, payloads: payloads,
+                lambda response: response))
+
+        self.assertEqual(resps, payloads)
+        self.assertEqual(sent, [[payloads[1]], [payloads[0]]])
+
+    def test_send_broker_aware_request_gives_up_after_retries(self):
+        broker = BrokerMetadata(0, 'broker_1', 4567)
+
+        with patch.object(KafkaClient, 'load_metadata_for_topics'):
+            client = KafkaClient(hosts=['broker_1:4567'], retries=2,
+                                 retry_backoff=0)
+        client.topic_partitions = {'topic': [0]}
+        client.topics_to_brokers = {TopicAndPartition('topic', 0): broker}
+
+        conn = MagicMock()
+        conn.send.side_effect = ConnectionError('broker_1 went away')
+
+        def restore_leader(*topics):
+            client.topics_to_brokers[TopicAndPartition('topic', 0)] = broker
+
+        with patch.object(KafkaClient, '_get_conn', return_value=conn), \
+                patch.object(KafkaClient, 'load_metadata_for_topics',
+                             side_effect=restore_leader):
+            with self.assertRaises(FailedPayloadsError):
+                client.send_produce_request([ProduceRequest('topic', 0, [])])
+
+        self.assertEqual(conn.send.call_count, 3)
+
+    @patch('kafka.client.selectors', None)
+    def test_iter_fetch_responses_yields_before_reading_other_brokers(self):
+        "Each broker's responses are yielded before the next one is read"
+
+        brokers = [BrokerMetadata(0, 'broker_1', 4567),
+                   BrokerMetadata(1, 'broker_2', 5678)]
+
+        with patch.object(KafkaClient, 'load_metadata_for_topics'):
+            client = KafkaClient(hosts=['broker_1:4567'])
+        client.topic_partitions = {'topic': [0, 1]}
+        client.topics_to_brokers = {
+            TopicAndPartition('topic', 0): brokers[0],
+            TopicAndPartition('topic', 1): brokers[1],
+        }
+
+        conns = {}
+        def mock_get_conn(host, port):
+            conn = conns[host] = MagicMock()
+            conn.has_response.return_value = False
+            conn.recv.return_value = host
+            return conn
+
+        def decode(response, **kwargs):
+            partition = 0 if response == 'broker_1' else 1
+            return [FetchResponse('topic', partition, 0, 0, [])]
+
+        with patch.object(KafkaClient, '_get_conn', side_effect=mock_get_conn), \
+                patch.object(KafkaClient, '_release_conn') as release, \
+                patch('kafka.client.KafkaProtocol') as protocol:
+            protocol.decode_fetch_response.side_effect = decode
+            resps = client.iter_fetch_responses([
+                FetchRequest('topic', 0, 0, 1024),
+                FetchRequest('topic', 1, 0, 1024)])
+
+            first = next(resps)
+            read = [host for host, conn in conns.items() if conn.recv.called]
+            self.assertEqual(read, ['broker_%d' % (first.partition + 1)])
+
+            # Stop early, the unread connection is closed before release
+            resps.close()
+            unread = 'broker_%d' % (2 - first.partition)
+            self.assertTrue(conns[unread].close.called)
+            self.assertEqual(release.call_count, 2)
+
+    def test_concurrent_produce_requests_are_coalesced(self):
+        "Produce calls within the window share one request per broker"
+
+        broker = BrokerMetadata(0, 'broker_1', 4567)
+        with patch.object(KafkaClient, 'load_metadata_for_topics'):
+            client = KafkaClient(hosts=['broker_1:4567'],
+                                 produce_coalesce_window=0.5)
+        client.topic_partitions = {'topic': [0, 1, 2]}
+        client.topics_to_brokers = dict(
+            (TopicAndPartition('topic', partition), broker)
+            for partition in (0, 1, 2))
+
+        batches = []
+        def send(payloads, encoder_fn, decoder_fn):
+            batches.append(payloads)
+            return [ProduceResponse(p.topic, p.partition, 0, 100 + p.partition)
+                    for p in payloads]
+
+        # partition 0 is produced to twice, so those two calls can't share
+        results = {}
+        def produce(partition, i):
+            results[i] = client.send_produce_request(
+                [ProduceRequest('topic', partition, [])])
+
+        with patch.object(KafkaClient, '_iter_broker_aware_request',
+                          side_effect=send):
+            threads = [threading.Thread(target=produce, args=(partition, i))
+                       for i, partition in enumerate([0, 1, 2, 0])]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        # Which calls end up together depends on the order the threads
+        # arrive in, so only check what holds for every order
+        self.assertEqual(len(batches), 2)
+        for batch in batches:
+            partitions = [p.partition for p in batch]
+            self.assertEqual(len(partitions), len(set(partitions)))
+        self.assertEqual(sorted(p.partition for batch in batches
+                                for p in batch), [0, 0, 1, 2])
+        for i, partition in enumerate([0, 1, 2, 0]):
+            self.assertEqual(results[i],
+                             [ProduceResponse('topic', partition, 0, 100 + partition)])
+
+        copied = client.copy()
+        self.assertIsNot(copied._produce_coalescer, client._produce_coalescer)
+
+    def _coalesced_produce(self, send, requests):
+        """
+        Produce each of requests from its own thread through a coalescing
+        client whose brokers are replaced by send, and return what each
+        call returned or raised
+        """
+        broker = BrokerMetadata(0, 'broker_1', 4567)
+        with patch.object(KafkaClient, 'load_metadata_for_topics'):
+            client = KafkaClient(hosts=['broker_1:4567'],
+                                 produce_coalesce_window=0.5)
+        client.topic_partitions = {'topic': [0, 1]}
+        client.topics_to_brokers = dict(
+            (TopicAndPartition('topic', partition), broker)
+            for partition in (0, 1))
+
+        results = {}
+        def produce(i, request):
+            try:
+                results[i] = client.send_produce_request([request])
+            except Exception as e:
+                results[i] = e
+
+        with patch.object(KafkaClient, '_iter_broker_aware_request',
+                          side_effect=send):
+            threads = [threading.Thread(target=produce, args=(i, request))
+                       for i, request in enumerate(requests)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return [results[i] for i in range(len(requests))]
+
+    def test_coalesced_produce__unknown_topic_fails_alone(self):
+        batches = []
+        def send(payloads, encoder_fn, decoder_fn):
+            batches.append(payloads)
+            for p in payloads:
+                if p.topic == 'nope':
+                    # Raised routing the batch, before anything is sent
+                    raise PartitionUnavailableError(p)
+            encoder_fn(client_id='client', correlation_id=1,
+                       payloads=payloads)
+            return [ProduceResponse(p.topic, p.partition, 0, 100)
+                    for p in payloads]
+
+        (ok, failed) = self._coalesced_produce(send, [
+            ProduceRequest('topic', 0, []),
+            ProduceRequest('nope', 0, [])])
+
+        self.assertEqual(len(batches[0]), 2)
+        self.assertEqual(ok, [ProduceResponse('topic', 0, 0, 100)])
+        self.assertIsInstance(failed, PartitionUnavailableError)
+
+    def test_coalesced_produce__failed_payloads_are_split(self):
+        batches = []
+        def send(payloads, encoder_fn, decoder_fn):
+            batches.append(payloads)
+            encoder_fn(client_id='client', correlation_id=1,
+                       payloads=payloads)
+            for p in payloads:
+                if p.partition == 0:
+                    yield ProduceResponse(p.topic, p.partition, 0, 100)
+            raise FailedPayloadsError([p for p in payloads
+                                       if p.partition == 1])
+
+        requests = [ProduceRequest('topic', 0, []),
+                    ProduceRequest('topic', 1, [])]
+        (ok, failed) = self._coalesced_produce(send, requests)
+
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(ok, [ProduceResponse('topic', 0, 0, 100)])
+        self.assertIsInstance(failed, FailedPayloadsError)
+        self.assertEqual(failed.args[0], [requests[1]])
+
+    def test_coalesced_produce__interrupted_sender_releases_batch(self):
+        "Callers that joined a batch are not left waiting if its sender dies"
+
+        class Interrupted(BaseException):
+            pass
+
+        coalescer = kafka.client._ProduceCoalescer(0.1)
+        key = (1, 1000)
+        sleep = time.sleep  # the module is patched, not just the client
+
+        def interrupted_sleep(window):
+            # Dies once the other caller has joined the batch
+            deadline = time.time() + 5
+            while (len(coalescer._open[key].payloads) < 2 and
+                   time.time() < deadline):
+                sleep(0.01)
+            raise Interrupted()
+
+        sent = []
+        def send(payloads, attempted):
+            sent.append(payloads)
+            return [ProduceResponse(p.topic, p.partition, 0, 100)
+                    for p in payloads]
+
+        requests = [ProduceRequest('topic', 0, []),
+                    ProduceRequest('topic', 1, [])]
+        results = {}
+        def produce(i):
+            try:
+                results[i] = coalescer.send(send, [requests[i]], 1, 1000)
+            except BaseException as e:
+                results[i] = e
+
+        with patch.object(kafka.client.time, 'sleep',
+                          side_effect=interrupted_sleep):
+            sender = threading.Thread(target=produce, args=(0,))
+            sender.daemon = True
+            sender.start()
+            while key not in coalescer._open:
+                sleep(0.01)
+            joiner = threading.Thread(target=produce, args=(1,))
+            joiner.daemon = True  # so a hung joiner fails rather than hangs
+            joiner.start()
+            sender.join(5)
+            joiner.join(5)
+
+        self.assertFalse(joiner.is_alive())
+        self.assertIsInstance(results[0], Interrupted)
+        # Nothing was sent for the joiner, so it sent its payload itself
+        self.assertEqual(results[1], [ProduceResponse('topic', 1, 0, 100)])
+        self.assertEqual(sent, [[requests[1]]])
+        self.assertEqual(coalescer._open, {})
+
+    def test_routing_index_is_rebuilt_only_when_metadata_changes(self):
+        broker_1 = BrokerMetadata(0, 'broker_1', 4567)
+        broker_2 = BrokerMetadata(1, 'broker_2', 5678)
+
+        with patch.object(KafkaClient, 'load_metadata_for_topics'):
+            client = KafkaClient(hosts=['broker_1:4567'])
+        client.topic_partitions = {'topic': [0, 1]}
+        client.topics_to_brokers = {
+            TopicAndPartition('topic', 0): broker_1,
+            TopicAndPartition('topic', 1): broker_2,
+        }
+
+        payloads = [FetchRequest('topic', 0, 0, 1024),
+                    FetchRequest('topic', 1, 0, 1024),
+                    FetchRequest('topic', 0, 10, 1024)]
+        self.assertEqual(client._group_by_leader(payloads), {
+            broker_1: [payloads[0], payloads[2]],
+            broker_2: [payloads[1]],
+        })
+
+        routes = client._get_routes()
+        self.assertIs(client._get_routes(), routes)
+
+        client.reset_broker_metadata(broker_2)
+        self.assertEqual(client._get_routes(), {'topic': {0: broker_1}})
+
+    def test_copy_shares_metadata_until_changed(self):
+        broker = BrokerMetadata(0, 'broker_1', 4567)
+        with patch.object(KafkaClient, 'load_metadata_for_topics'):
+            client = KafkaClient(hosts=['broker_1:4567'])
+        client.topic_partitions = {'topic': [0]}
+        client.topics_to_brokers = {TopicAndPartition('topic', 0): broker}
+        client._get_pool('broker_1', 4567)
+
+        copied = client.copy()
+        self.assertEqual(copied.conns, {})
+        self.assertIs(copied.topics_to_brokers, client.topics_to_brokers)
+
+        copied.reset_topic_metadata('topic')
+        self.assertEqual(copied.topics_to_brokers, {})
+        self.assertEqual(client.topics_to_brokers,
+                         {TopicAndPartition('topic', 0): broker})
+        self.assertEqual(client.topic_partitions, {'topic': [0]})
+
+        # the original copies them too before changing them
+        client.reset_all_metadata()
+        self.assertEqual(client.topics_to_brokers, {})
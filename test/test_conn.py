@@ -1,8 +1,56 @@
 import os
 import random
+import socket
 import struct
+import threading
+import time
 import unittest2
+
+from mock import MagicMock, call, patch
+
 import kafka.conn
+from kafka.common import ConnectionError
+from kafka.conn import KafkaConnection, KafkaConnectionPool
+from kafka.metrics import ConnectionMetrics
+
+
+class FakeSocket(object):
+    """
+    Stands in for a connected socket, serving reads from a byte stream
+    """
+    def __init__(self, stream=b''):
+        self.stream = stream
+        self.sent = []
+
+    def sendall(self, payload):
+        self.sent.append(payload)
+
+    def recv(self, num_bytes):
+        data, self.stream = self.stream[:num_bytes], self.stream[num_bytes:]
+        return data
+
+    def recv_into(self, buf, num_bytes):
+        data = self.recv(num_bytes)
+        buf[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        pass
+
+
+def connected_to(sock, **kwargs):
+    """
+    Create a KafkaConnection and connect it to the given socket
+    """
+    conn = KafkaConnection('localhost', 9092, **kwargs)
+    with patch.object(KafkaConnection, '_create_socket', return_value=sock):
+        conn.reinit()
+    return conn
+
+
+def encode_response(correlation_id, body):
+    return struct.pack('>ii', len(body) + 4, correlation_id) + body
+
 
 class ConnTest(unittest2.TestCase):
     def test_collect_hosts__happy_path(self):
@@ -36,6 +84,55 @@ class ConnTest(unittest2.TestCase):
             ('localhost', 9092),
         ]))
 
+    def test_connect__applies_socket_options_before_connecting(self):
+        options = [
+            (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+            (socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024),
+        ]
+        with patch('kafka.conn.socket.socket') as socket_class:
+            sock = socket_class.return_value
+            KafkaConnection('localhost', 9092, timeout=5,
+                            socket_options=options, connect_timeout=1).reinit()
+
+        setsockopt_calls = [c for c in sock.method_calls if c[0] == 'setsockopt']
+        self.assertEqual(setsockopt_calls,
+                         [call.setsockopt(*option) for option in options])
+        self.assertEqual([c[0] for c in sock.method_calls[len(options):]],
+                         ['settimeout', 'connect', 'settimeout'])
+
+        # The short connect timeout only applies while connecting
+        self.assertEqual(sock.settimeout.call_args_list, [call(1), call(5)])
+
+    def test_connect__failure_raises_connection_error(self):
+        with patch('kafka.conn.socket.socket') as socket_class:
+            socket_class.return_value.connect.side_effect = socket.timeout()
+            with self.assertRaises(ConnectionError):
+                KafkaConnection('localhost', 9092).reinit()
+
+    def test_connect__nodelay_by_default(self):
+        with patch('kafka.conn.socket.socket') as socket_class:
+            sock = socket_class.return_value
+            KafkaConnection('localhost', 9092).reinit()
+
+        sock.setsockopt.assert_called_once_with(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def test_init__does_not_connect(self):
+        with patch.object(KafkaConnection, '_create_socket') as create_socket:
+            conn = KafkaConnection('localhost', 9092)
+            copied = conn.copy()
+
+        self.assertFalse(create_socket.called)
+        self.assertIsNot(copied, conn)
+
+    def test_send__connects_on_first_use(self):
+        sock = FakeSocket()
+        conn = KafkaConnection('localhost', 9092)
+        with patch.object(KafkaConnection, '_create_socket', return_value=sock):
+            conn.send(1, b'request')
+
+        self.assertEqual(sock.sent, [b'request'])
+
     @unittest2.skip("Not Implemented")
     def test_send(self):
         pass
@@ -48,9 +145,102 @@ class ConnTest(unittest2.TestCase):
     def test_send__failure_sets_dirty_connection(self):
         pass
 
-    @unittest2.skip("Not Implemented")
+    def test_send__segments_with_partial_writes(self):
+        sent = []
+
+        def sendmsg(buffers):
+            # Write at most 3 bytes per call
+            data = b''.join(memoryview(b).tobytes() for b in buffers)[:3]
+            sent.append(data)
+            return len(data)
+
+        sock = FakeSocket()
+        sock.sendmsg = sendmsg
+        conn = connected_to(sock)
+
+        conn.send(1, [b'abcd', b'e', b'fghij'])
+        self.assertEqual(b''.join(sent), b'abcdefghij')
+        self.assertEqual(sock.sent, [])
+
+    def test_send__segments_without_sendmsg(self):
+        sock = FakeSocket()
+        conn = connected_to(sock)
+
+        conn.send(1, [b'abcd', b'e', b'fghij'])
+        self.assertEqual(sock.sent, [b'abcdefghij'])
+
     def test_recv(self):
-        pass
+        sock = FakeSocket(encode_response(1, b'response 1'))
+        conn = connected_to(sock)
+
+        self.assertEqual(bytes(conn.recv(1)), struct.pack('>i', 1) + b'response 1')
+
+    def test_recv__fills_one_buffer_with_recv_into(self):
+        body = struct.pack('>i', 1) + b'x' * 100000
+        sock = FakeSocket(struct.pack('>i', len(body)) + body)
+        conn = connected_to(sock)
+
+        with patch.object(sock, 'recv', wraps=sock.recv) as recv:
+            resp = conn.recv(1)
+
+        self.assertEqual(bytes(resp), body)
+        self.assertEqual(recv.call_count, 2)  # size header, then body
+
+    def test_recv__failure_on_closed_socket(self):
+        sock = FakeSocket(struct.pack('>i', 10) + b'short')
+        conn = connected_to(sock)
+
+        with self.assertRaises(ConnectionError):
+            conn.recv(1)
+        self.assertTrue(conn._dirty)
+
+    def test_recv__out_of_order_responses_are_buffered(self):
+        sock = FakeSocket(b''.join([
+            encode_response(1, b'response 1'),
+            encode_response(2, b'response 2'),
+            encode_response(3, b'response 3'),
+        ]))
+        conn = connected_to(sock)
+
+        for request_id in (1, 2, 3):
+            conn.send(request_id, b'request')
+
+        self.assertEqual(bytes(conn.recv(3)), struct.pack('>i', 3) + b'response 3')
+        self.assertEqual(bytes(conn.recv(1)), struct.pack('>i', 1) + b'response 1')
+        self.assertEqual(bytes(conn.recv(2)), struct.pack('>i', 2) + b'response 2')
+        self.assertEqual(sock.stream, b'')
+
+    def test_metrics__count_io_when_enabled(self):
+        sock = FakeSocket(encode_response(1, b'response 1'))
+        metrics = ConnectionMetrics()
+        conn = connected_to(sock, metrics=metrics)
+
+        conn.send(1, b'request')
+        conn.recv(1)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['connects'], 1)
+        self.assertEqual(snapshot['requests'], 1)
+        self.assertEqual(snapshot['responses'], 1)
+        self.assertEqual(snapshot['bytes_sent'], len(b'request'))
+        self.assertEqual(snapshot['bytes_received'],
+                         len(encode_response(1, b'response 1')))
+        self.assertEqual(snapshot['send_calls'], 1)
+        self.assertEqual(snapshot['recv_calls'], 2)
+        for name in ('connect_time', 'send_time', 'first_byte_time',
+                     'body_read_time'):
+            self.assertEqual(snapshot[name]['count'], 1)
+
+    def test_send__reconnects_after_fork(self):
+        conn = connected_to(FakeSocket())
+        child_sock = FakeSocket()
+
+        with patch.object(KafkaConnection, '_create_socket',
+                          return_value=child_sock), \
+                patch('kafka.conn.os.getpid', return_value=-1):
+            conn.send(1, b'request')
+
+        self.assertEqual(child_sock.sent, [b'request'])
 
     @unittest2.skip("Not Implemented")
     def test_recv__reconnects_on_dirty_conn(self):
@@ -67,3 +257,106 @@ class ConnTest(unittest2.TestCase):
     @unittest2.skip("Not Implemented")
     def test_close__object_is_reusable(self):
         pass
+
+
+@patch('kafka.conn.KafkaConnection', side_effect=lambda *a, **kw: MagicMock())
+class ConnectionPoolTest(unittest2.TestCase):
+    def test_checkout__reuses_checked_in_connection(self, conn_class):
+        pool = KafkaConnectionPool('localhost', 9092)
+
+        conn = pool.checkout()
+        pool.checkin(conn)
+
+        self.assertIs(pool.checkout(), conn)
+        self.assertEqual(conn_class.call_count, 1)
+
+    def test_checkout__opens_up_to_size_connections(self, conn_class):
+        pool = KafkaConnectionPool('localhost', 9092, timeout=0.01, size=2)
+
+        conns = set([pool.checkout(), pool.checkout()])
+        self.assertEqual(len(conns), 2)
+
+        with self.assertRaises(ConnectionError):
+            pool.checkout()
+
+    def test_checkout__waits_for_checkin(self, conn_class):
+        pool = KafkaConnectionPool('localhost', 9092, size=1)
+        conn = pool.checkout()
+
+        checked_out = []
+        waiter = threading.Thread(target=lambda: checked_out.append(pool.checkout()))
+        waiter.start()
+        time.sleep(0.01)
+        self.assertEqual(checked_out, [])
+
+        pool.checkin(conn)
+        waiter.join(1)
+        self.assertEqual(checked_out, [conn])
+
+    def test_checkout__fails_fast_during_reconnect_backoff(self, conn_class):
+        pool = KafkaConnectionPool('localhost', 9092, reconnect_backoff=60)
+
+        pool.checkin(pool.checkout(), failed=True)
+        self.assertTrue(pool.in_backoff())
+        with self.assertRaises(ConnectionError):
+            pool.checkout()
+
+        # Once the backoff is over, a successful request resets it
+        pool._retry_at = 0
+        pool.checkin(pool.checkout())
+        self.assertEqual(pool._failures, 0)
+
+    def test_checkout__backoff_doubles_with_failures(self, conn_class):
+        pool = KafkaConnectionPool('localhost', 9092, reconnect_backoff=1,
+                                   max_reconnect_backoff=3)
+
+        backoffs = []
+        for _ in range(4):
+            conn = pool.checkout()
+            start = time.time()
+            pool.checkin(conn, failed=True)
+            backoffs.append(pool._retry_at - start)
+            pool._retry_at = 0
+
+        for backoff, expected in zip(backoffs, [1, 2, 3, 3]):
+            self.assertTrue(0.8 * expected <= backoff <= 1.2 * expected + 0.01)
+
+    def test_checkout__failed_connect_starts_backoff(self, conn_class):
+        conn_class.side_effect = KafkaConnection
+
+        # A port nothing listens on any more, so connecting is refused
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        port = listener.getsockname()[1]
+        listener.close()
+
+        pool = KafkaConnectionPool('127.0.0.1', port, reconnect_backoff=60)
+        with self.assertRaises(ConnectionError):
+            with pool.connection() as conn:
+                conn.send(1, b'request')
+
+        self.assertTrue(pool.in_backoff())
+        with self.assertRaises(ConnectionError):
+            pool.checkout()
+
+    def test_checkout__closes_idle_connections(self, conn_class):
+        pool = KafkaConnectionPool('localhost', 9092, size=1, max_idle=60)
+
+        with pool.connection() as conn:
+            pass
+
+        # Pretend the connection was last used long ago
+        pool._idle = [(conn, time.time() - 61)]
+
+        self.assertIsNot(pool.checkout(), conn)
+        conn.close.assert_called_once_with()
+
+    def test_checkout__starts_afresh_after_fork(self, conn_class):
+        pool = KafkaConnectionPool('localhost', 9092, size=1)
+        parent_conn = pool.checkout()
+        pool.checkin(parent_conn)
+
+        with patch('kafka.conn.os.getpid', return_value=-1):
+            conn = pool.checkout()
+
+        self.assertIsNot(conn, parent_conn)
@@ -3,13 +3,14 @@ import random
 import struct
 import unittest2
 
-from mock import MagicMock, patch
+from mock import ANY, MagicMock, patch
 
 from kafka import KafkaClient
-from kafka.consumer import SimpleConsumer
+from kafka.consumer import SimpleConsumer, FetchScheduler
 from kafka.common import (
-    ProduceRequest, BrokerMetadata, PartitionMetadata,
-    TopicAndPartition, KafkaUnavailableError,
+    ProduceRequest, FetchRequest, FetchResponse, OffsetFetchRequest,
+    BrokerMetadata, PartitionMetadata,
+    TopicAndPartition, KafkaUnavailableError, ConsumerFetchSizeTooSmall,
     LeaderUnavailableError, PartitionUnavailableError
 )
 from kafka.protocol import (
@@ -20,3 +21,75 @@ class TestKafkaConsumer(unittest2.TestCase):
     def test_non_integer_partitions(self):
         with self.assertRaises(AssertionError):
             consumer = SimpleConsumer(MagicMock(), 'group', 'topic', partitions = [ '0' ])
+
+    def test_offsets_are_fetched_with_one_request(self):
+        client = MagicMock()
+        client.topic_partitions = {'topic': [0, 1, 2]}
+        client.send_offset_fetch_request.return_value = [5, 6, 7]
+
+        consumer = SimpleConsumer(client, 'group', 'topic',
+                                  auto_commit_every_t=None)
+
+        client.send_offset_fetch_request.assert_called_once_with(
+            'group',
+            [OffsetFetchRequest('topic', 0), OffsetFetchRequest('topic', 1),
+             OffsetFetchRequest('topic', 2)],
+            callback=ANY, fail_on_error=False)
+        self.assertEqual(consumer.offsets, {0: 5, 1: 6, 2: 7})
+
+    def test_fetch_buffer_doubles_up_to_max_buffer_size(self):
+        client = MagicMock()
+        client.topic_partitions = {'topic': [0]}
+        consumer = SimpleConsumer(client, 'group', 'topic', auto_commit=False,
+                                  buffer_size=4096, max_buffer_size=12288)
+
+        too_small = MagicMock()
+        too_small.partition = 0
+        too_small.messages.__iter__.side_effect = ConsumerFetchSizeTooSmall
+
+        sizes = []
+        for _ in range(2):
+            self.assertTrue(consumer._handle_fetch_response(too_small))
+            sizes.append(consumer.buffer_size)
+        self.assertEqual(sizes, [8192, 12288])
+
+        with self.assertRaises(ConsumerFetchSizeTooSmall):
+            consumer._handle_fetch_response(too_small)
+
+
+class TestFetchScheduler(unittest2.TestCase):
+    def test_fetches_for_all_consumers_at_once(self):
+        client = MagicMock()
+        client.topic_partitions = {'topic_1': [0], 'topic_2': [0, 1]}
+        scheduler = FetchScheduler(client)
+
+        consumers = [
+            SimpleConsumer(client, 'group', topic, auto_commit=False,
+                           fetch_scheduler=scheduler)
+            for topic in ('topic_1', 'topic_2')
+        ]
+        # A second consumer of topic_1 partition 0 can't share the request
+        consumers.append(SimpleConsumer(client, 'other', 'topic_1',
+                                        auto_commit=False,
+                                        fetch_scheduler=scheduler))
+
+        message = MagicMock(offset=0)
+        def iter_fetch_responses(requests, **kwargs):
+            return [FetchResponse(r.topic, r.partition, 0, 1, [message])
+                    for r in requests]
+        client.iter_fetch_responses.side_effect = iter_fetch_responses
+
+        self.assertIs(consumers[0].get_message(), message)
+
+        calls = client.iter_fetch_responses.call_args_list
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(sorted(calls[0][0][0]), [
+            FetchRequest('topic_1', 0, 0, 4096),
+            FetchRequest('topic_2', 0, 0, 4096),
+            FetchRequest('topic_2', 1, 0, 4096),
+        ])
+        self.assertEqual(calls[1][0][0], [FetchRequest('topic_1', 0, 0, 4096)])
+
+        self.assertEqual(consumers[1].queue.qsize(), 2)
+        self.assertEqual(consumers[2].queue.qsize(), 1)
+        self.assertEqual(consumers[0].fetch_offsets, {0: 1})
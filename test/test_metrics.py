@@ -0,0 +1,41 @@
+import unittest2
+
+from kafka.metrics import ConnectionMetrics, Histogram
+
+
+class TestHistogram(unittest2.TestCase):
+    def test_record(self):
+        histogram = Histogram()
+        for value in (0.0002, 0.003, 0.003, 120):
+            histogram.record(value)
+
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['count'], 4)
+        self.assertAlmostEqual(snapshot['total'], 120.0062)
+        self.assertEqual(snapshot['max'], 120)
+        self.assertEqual(snapshot['p50'], 0.005)
+        self.assertEqual(snapshot['p99'], 120)
+        self.assertEqual(snapshot['buckets'][-1], (float('inf'), 1))
+
+    def test_empty(self):
+        snapshot = Histogram().snapshot()
+        self.assertEqual(snapshot['count'], 0)
+        self.assertIsNone(snapshot['mean'])
+        self.assertIsNone(snapshot['p50'])
+
+
+class TestConnectionMetrics(unittest2.TestCase):
+    def test_snapshot_and_reset(self):
+        metrics = ConnectionMetrics()
+        metrics.incr('requests')
+        metrics.incr('bytes_sent', 100)
+        metrics.observe('send_time', 0.01)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['requests'], 1)
+        self.assertEqual(snapshot['bytes_sent'], 100)
+        self.assertEqual(snapshot['send_time']['count'], 1)
+
+        metrics.reset()
+        self.assertEqual(metrics.snapshot()['requests'], 0)
+        self.assertEqual(snapshot['requests'], 1)  # snapshots are copies
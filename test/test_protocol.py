@@ -2,6 +2,7 @@ import contextlib
 from contextlib import contextmanager
 import struct
 import unittest2
+import zlib
 
 import mock
 from mock import sentinel
@@ -24,7 +25,7 @@ import kafka.protocol
 from kafka.protocol import (
     ATTRIBUTE_CODEC_MASK, CODEC_NONE, CODEC_GZIP, CODEC_SNAPPY, KafkaProtocol,
     create_message, create_gzip_message, create_snappy_message,
-    create_message_set
+    create_message_set, MessageBatch
 )
 from kafka import compat
 
@@ -121,6 +122,21 @@ class TestProtocol(unittest2.TestCase):
 
         self.assertEqual(encoded, expect)
 
+    def test_encode_message__null_key(self):
+        message = create_message(b"test")
+        encoded = KafkaProtocol._encode_message(message)
+        body = b"".join([
+            struct.pack(">bb", 0, 0),       # Magic, flags
+            struct.pack(">i", -1),          # Null key
+            struct.pack(">i", 4),           # Length of value
+            b"test",                         # value
+        ])
+
+        self.assertEqual(encoded,
+                         struct.pack(">I", zlib.crc32(body) & 0xffffffff) + body)
+        self.assertEqual(list(KafkaProtocol._decode_message(encoded, 0)),
+                         [(0, message)])
+
     def test_decode_message(self):
         encoded = b"".join([
             struct.pack(">i", -1427009701), # CRC
@@ -249,6 +265,18 @@ class TestProtocol(unittest2.TestCase):
         iter = KafkaProtocol._decode_message(invalid_encoded_message, 0)
         self.assertRaises(ChecksumError, list, iter)
 
+    def test_decode_message__without_crc_check(self):
+        encoded = bytearray(KafkaProtocol._encode_message(
+            create_message(b"test", b"key")))
+        encoded[-1:] = b"x"
+
+        with self.assertRaises(ChecksumError):
+            list(KafkaProtocol._decode_message(bytes(encoded), 0))
+
+        messages = list(KafkaProtocol._decode_message(bytes(encoded), 0,
+                                                      check_crcs=False))
+        self.assertEqual(messages, [(0, create_message(b"tesx", b"key"))])
+
     # NOTE: The error handling in _decode_message_set_iter() is questionable.
     # If it's modified, the next two tests might need to be fixed.
     def test_decode_message_set_fetch_size_too_small(self):
@@ -402,9 +430,9 @@ class TestProtocol(unittest2.TestCase):
         t1 = "topic1"
         t2 = "topic2"
         msgs = list(map(create_message, [b"message1", b"hi", b"boo", b"foo", b"so fun!"]))
-        ms1 = KafkaProtocol._encode_message_set([msgs[0], msgs[1]])
-        ms2 = KafkaProtocol._encode_message_set([msgs[2]])
-        ms3 = KafkaProtocol._encode_message_set([msgs[3], msgs[4]])
+        ms1 = bytes(KafkaProtocol._encode_message_set([msgs[0], msgs[1]]))
+        ms2 = bytes(KafkaProtocol._encode_message_set([msgs[2]]))
+        ms3 = bytes(KafkaProtocol._encode_message_set([msgs[3], msgs[4]]))
 
         encoded = struct.pack('>iih%dsiihqi%dsihqi%dsh%dsiihqi%ds' %
                               (len(t1), len(ms1), len(ms2), len(t2), len(ms3)),
@@ -426,6 +454,118 @@ class TestProtocol(unittest2.TestCase):
                                                OffsetAndMessage(0, msgs[4])])]
         self.assertEqual(expanded_responses, expect)
 
+    def test_decode_fetch_response__views(self):
+        msgs = [create_message(b"v1", b"k1"), create_message(b"v2")]
+        ms = bytes(KafkaProtocol._encode_message_set(msgs))
+        encoded = bytearray(b"".join([
+            struct.pack('>iih6si', 4, 1, 6, b"topic1", 1),
+            struct.pack('>ihqi', 0, 0, 10, len(ms)),
+            ms,
+        ]))
+
+        (response,) = KafkaProtocol.decode_fetch_response(
+            compat.buffer(encoded), views=True)
+        messages = [message for (offset, message) in response.messages]
+
+        self.assertNotIsInstance(messages[0].value, bytes)
+        self.assertEqual([(bytes(m.key) if m.key is not None else None,
+                           bytes(m.value)) for m in messages],
+                         [(b"k1", b"v1"), (None, b"v2")])
+
+        # The values are views of the response, not copies of it
+        encoded[-1:] = b"x"
+        self.assertEqual(bytes(messages[1].value), b"vx")
+
+    def _fetch_response(self, message_set):
+        return b"".join([
+            struct.pack('>iih6si', 4, 1, 6, b"topic1", 1),
+            struct.pack('>ihqi', 0, 0, 10, len(message_set)),
+            bytes(message_set),
+        ])
+
+    def test_decode_fetch_response__columnar(self):
+        def message_set(offset_and_messages):
+            return b"".join(
+                struct.pack('>qi', offset, len(encoded)) + encoded
+                for (offset, encoded) in
+                ((offset, KafkaProtocol._encode_message(message))
+                 for (offset, message) in offset_and_messages))
+
+        inner = message_set([(6, create_message(b"v6")),
+                             (7, create_message(b"v7", b"k7"))])
+        compressed = Message(0, ATTRIBUTE_CODEC_MASK & CODEC_GZIP, None,
+                             gzip_encode(inner))
+        encoded = self._fetch_response(message_set([
+            (5, create_message(b"v5", b"k5")),
+            (7, compressed),
+            (8, create_message(None, b"k8")),
+        ]))
+
+        (response,) = KafkaProtocol.decode_fetch_response(encoded,
+                                                          columnar=True)
+        (expected,) = KafkaProtocol.decode_fetch_response(encoded)
+        batch = response.messages
+
+        self.assertIsInstance(batch, MessageBatch)
+        self.assertEqual(len(batch), 4)
+        self.assertEqual(list(batch.offsets), [5, 6, 7, 8])
+        self.assertEqual(list(batch.key_lengths), [2, -1, 2, 2])
+        self.assertEqual(list(batch.value_lengths), [2, 2, 2, -1])
+        self.assertEqual([batch.value(i) for i in range(4)],
+                         [b"v5", b"v6", b"v7", None])
+        self.assertFalse(batch.truncated)
+        self.assertEqual(list(batch), list(expected.messages))
+
+    def test_decode_fetch_response__columnar_truncated(self):
+        ms = KafkaProtocol._encode_message_set([create_message(b"v1"),
+                                                create_message(b"v2")])
+
+        (response,) = KafkaProtocol.decode_fetch_response(
+            self._fetch_response(ms[:-1]), columnar=True)
+        self.assertEqual(len(response.messages), 1)
+        self.assertTrue(response.messages.truncated)
+
+        (response,) = KafkaProtocol.decode_fetch_response(
+            self._fetch_response(ms[:10]), columnar=True)
+        self.assertEqual(len(response.messages), 0)
+        with self.assertRaises(ConsumerFetchSizeTooSmall):
+            list(response.messages)
+
+    def test_decode_fetch_response__columnar_checksum_error(self):
+        ms = bytearray(KafkaProtocol._encode_message_set(
+            [create_message(b"v1")]))
+        ms[-1:] = b"x"
+        encoded = self._fetch_response(bytes(ms))
+
+        with self.assertRaises(ChecksumError):
+            list(KafkaProtocol.decode_fetch_response(encoded, columnar=True))
+
+        (response,) = KafkaProtocol.decode_fetch_response(
+            encoded, columnar=True, check_crcs=False)
+        self.assertEqual(response.messages.value(0), b"vx")
+
+    @unittest2.skipUnless(kafka.protocol._has_numpy, "NumPy not available")
+    def test_message_batch_to_numpy(self):
+        ms = KafkaProtocol._encode_message_set([create_message(b"v1", b"k"),
+                                                create_message(b"v22")])
+        (response,) = KafkaProtocol.decode_fetch_response(
+            self._fetch_response(ms), columnar=True)
+
+        columns = response.messages.to_numpy()
+        self.assertEqual(columns['offsets'].tolist(), [0, 0])
+        self.assertEqual(columns['value_lengths'].tolist(), [2, 3])
+        start = columns['value_starts'][1]
+        self.assertEqual(columns['buffer'][start:start + 3].tobytes(), b"v22")
+
+    def test_message_batch_to_numpy__without_numpy(self):
+        ms = KafkaProtocol._encode_message_set([create_message(b"v1")])
+        (response,) = KafkaProtocol.decode_fetch_response(
+            self._fetch_response(ms), columnar=True)
+
+        with mock.patch('kafka.protocol._has_numpy', False):
+            with self.assertRaises(ImportError):
+                response.messages.to_numpy()
+
     def test_encode_metadata_request_no_topics(self):
         expected = b"".join([
             struct.pack(">i", 17),         # Total length of the request
@@ -79,6 +79,18 @@ class UtilTest(unittest2.TestCase):
         with self.assertRaises(kafka.common.BufferUnderflowError):
             kafka.util.relative_unpack('>hh', '\x00', 0)
 
+    def test_relative_unpack_from(self):
+        self.assertEqual(
+            kafka.util.relative_unpack_from(kafka.util.INT16,
+                                            b'\x00\x00\x00\x07\x00', 2),
+            ((7,), 4)
+        )
+        with self.assertRaises(kafka.common.BufferUnderflowError):
+            kafka.util.relative_unpack_from(kafka.util.INT32, b'\x00\x00', 0)
+
+    def test_get_struct__cached(self):
+        self.assertIs(kafka.util.get_struct('>iq'), kafka.util.get_struct('>iq'))
+        self.assertIs(kafka.util.get_struct('>i'), kafka.util.INT32)
 
     def test_group_by_topic_and_partition(self):
         t = kafka.common.TopicAndPartition